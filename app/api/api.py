@@ -41,7 +41,7 @@ class API(object):
                 doc.load(request.args['url'])
             elif request.files and request.files["document"]:
                 docstream = request.files["document"].stream
-                doc.loadXml(docstream.read())
+                doc.loadStream(docstream)
             elif request.data:
                 doc.loadXml(request.data)
             else:
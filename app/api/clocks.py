@@ -22,6 +22,9 @@ import queue
 import threading
 import functools
 
+import logging
+logger = logging.getLogger(__name__)
+
 @functools.total_ordering
 class NeverSmaller(object):
     """This object is greater than any number"""
@@ -247,7 +250,7 @@ class CallbackPausableClock(PausableClock):
             t, _, callback, args, kwargs = peek
             if self._now() >= t:
                 if self._now() > t + 0.1:
-                    print('xxxjack scheduling', self.now() - t, 'seconds too late...')
+                    logger.warning('scheduling callback %f seconds too late' % (self._now() - t))
                 handler.schedule(callback, *args, **kwargs)
             else:
                 assert not self.queue.full()
@@ -0,0 +1,235 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+#
+# Asynchronous delivery of document changes to REST callbacks.
+#
+# Every callback URL has its own queue, so a slow or dead callback does not hold up the others (or the
+# edit that produced the changes). The queues of all documents are drained by one shared pool of worker
+# threads, with at most one worker per callback at any time so the changes arrive in order. A worker
+# makes a single attempt per delivery: failed ones are retried later from a timer, so workers never sit
+# out a backoff delay while other callbacks wait. A callback that keeps failing, or that falls too far
+# behind, is evicted: it has missed changes and has to resynchronize anyway.
+#
+import collections
+import queue
+import threading
+import time
+import requests
+
+import logging
+logger = logging.getLogger(__name__)
+
+WORKERS = 4         # Maximum number of worker threads
+MAX_QUEUE = 100     # Maximum number of undelivered requests per callback
+TIMEOUT = 5         # Timeout (seconds) for a single PUT
+CONNECT_TIMEOUT = 1 # Timeout (seconds) for connecting to the callback, so dead hosts do not hold up a worker
+RETRIES = 3         # Number of retries of a failed PUT before the callback is evicted
+BACKOFF = 0.5       # Delay (seconds) before the first retry, doubled for every next one
+
+
+def _put(url, args, timeout):
+    r = requests.put(url, json=args, timeout=(min(CONNECT_TIMEOUT, timeout), timeout))
+    r.raise_for_status()
+
+
+class CallbackQueue(object):
+    """Undelivered requests for a single callback URL"""
+
+    def __init__(self, pool, url):
+        self.pool = pool
+        self.url = url
+        self.pending = collections.deque()
+        self.busy = False   # A worker is delivering requests from this queue (or a retry is due)
+        self.failures = 0   # Failed attempts at delivering the first request
+
+
+class Workers(object):
+    """Worker threads that deliver the requests of the CallbackQueues of any number of DeliveryPools.
+    Threads are started when needed, up to a maximum, and stay around for later deliveries."""
+
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.ready = queue.Queue()  # CallbackQueues with pending requests and no worker
+        self.threads = []
+        self.idleWorkers = 0
+
+    def schedule(self, cbQueue):
+        """Have a worker deliver the next request from cbQueue"""
+        with self.lock:
+            self.ready.put(cbQueue)
+            self._startWorker()
+
+    def _startWorker(self):
+        """Start another worker if all are busy and we are below the maximum. Called with the lock held."""
+        self.threads = [t for t in self.threads if t.is_alive()]
+        if len(self.threads) >= self.workers or self.ready.qsize() <= self.idleWorkers:
+            return
+        t = threading.Thread(target=self._run, name='delivery-%d' % len(self.threads))
+        t.daemon = True
+        self.threads.append(t)
+        self.idleWorkers += 1
+        t.start()
+
+    def _run(self):
+        while True:
+            cbQueue = self.ready.get()
+            with self.lock:
+                self.idleWorkers -= 1
+            try:
+                cbQueue.pool._deliver(cbQueue)
+            except Exception:
+                logger.exception('delivery to %s failed' % cbQueue.url)
+            finally:
+                with self.lock:
+                    self.idleWorkers += 1
+
+
+# The worker threads shared by all documents
+SHARED_WORKERS = Workers()
+
+
+class DeliveryPool(object):
+    """Callback URLs that get PUT requests delivered asynchronously by workers, in order per callback.
+    onEvict(url, reason) is called (from a worker thread) when a callback is evicted."""
+
+    def __init__(self, onEvict=None, workers=None, maxQueue=MAX_QUEUE, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF, send=_put):
+        self.onEvict = onEvict
+        self.workers = workers if workers is not None else SHARED_WORKERS
+        self.maxQueue = maxQueue
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.send = send
+        self.lock = threading.Lock()
+        self.queues = collections.OrderedDict()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.queues)
+
+    def __contains__(self, url):
+        with self.lock:
+            return url in self.queues
+
+    def urls(self):
+        """Return the callback URLs, in order of registration"""
+        with self.lock:
+            return list(self.queues.keys())
+
+    def add(self, url):
+        with self.lock:
+            if not url in self.queues:
+                self.queues[url] = CallbackQueue(self, url)
+
+    def discard(self, url):
+        """Remove a callback. Requests that have not been delivered yet are dropped."""
+        with self.lock:
+            cbQueue = self.queues.pop(url, None)
+            if cbQueue is not None:
+                cbQueue.pending.clear()
+
+    def put(self, url, args):
+        """Queue a PUT of JSON args to callback url. Returns immediately."""
+        with self.lock:
+            cbQueue = self.queues.get(url)
+            if cbQueue is None:
+                return
+            if len(cbQueue.pending) >= self.maxQueue:
+                overflow = True
+            else:
+                overflow = False
+                cbQueue.pending.append(args)
+                if not cbQueue.busy:
+                    cbQueue.busy = True
+                    self.workers.schedule(cbQueue)
+        if overflow:
+            self._evict(url, 'more than %d requests not delivered' % self.maxQueue)
+
+    def _deliver(self, cbQueue):
+        """Make one attempt at delivering the first request from cbQueue, and reschedule the queue if there
+        is more to do. A failed attempt is retried after a delay, from a timer, so the worker is free in the
+        mean time. The queue is never left busy, whatever happens during the delivery."""
+        with self.lock:
+            if not cbQueue.pending:
+                cbQueue.busy = False
+                return
+            args = cbQueue.pending[0]
+        delivered = False
+        retryDelay = None
+        try:
+            error, retry = self._send(cbQueue, args)
+            if error is None:
+                delivered = True
+            elif retry and cbQueue.failures <= self.retries:
+                retryDelay = self.backoff * 2 ** (cbQueue.failures - 1)
+            else:
+                self._evict(cbQueue.url, error)
+        finally:
+            with self.lock:
+                if delivered:
+                    cbQueue.failures = 0
+                    if cbQueue.pending:
+                        cbQueue.pending.popleft()
+                if retryDelay is not None and cbQueue.pending:
+                    timer = threading.Timer(retryDelay, self.workers.schedule, [cbQueue])
+                    timer.daemon = True
+                    timer.start()
+                elif delivered and cbQueue.pending:
+                    self.workers.schedule(cbQueue)
+                else:
+                    cbQueue.busy = False
+
+    def _send(self, cbQueue, args):
+        """PUT args to the callback once. Returns None or an error message, and whether to retry."""
+        url = cbQueue.url
+        requestStartTime = time.time()
+        try:
+            self.send(url, args, self.timeout)
+        except requests.exceptions.RequestException as e:
+            cbQueue.failures += 1
+            logger.warning('PUT to %s failed (attempt %d): %s' % (url, cbQueue.failures, e))
+            return 'PUT failed %d times' % cbQueue.failures, True
+        except Exception as e:
+            logger.exception('PUT to %s failed unexpectedly' % url)
+            return 'PUT failed: %s' % e, False
+        requestDuration = time.time() - requestStartTime
+        if requestDuration > 2:
+            logger.warning('PUT took %d seconds for %s' % (requestDuration, url))
+        return None, False
+
+    def _evict(self, url, reason):
+        if not url in self:
+            return
+        logger.warning('evicting callback %s: %s' % (url, reason))
+        self.discard(url)
+        if self.onEvict:
+            self.onEvict(url, reason)
+
+    def wait(self, timeout=None):
+        """Wait until all queued requests have been delivered (or dropped). Returns False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self.lock:
+                if not any(q.busy for q in self.queues.values()):
+                    return True
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
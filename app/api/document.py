@@ -21,9 +21,14 @@ from builtins import object
 from flask import Response, request, abort
 from socketIO_client import SocketIO, SocketIONamespace
 import urllib.request, urllib.error, urllib.parse
+import io
 import json
 import copy
-import xml.etree.ElementTree as ET
+import math
+import collections
+import contextlib
+import functools
+import inspect
 import re
 import threading
 import os
@@ -32,6 +37,10 @@ import time
 import requests
 from .globalSettings import GlobalSettings
 from . import clocks
+from . import delivery
+from . import history
+from . import rwlock
+from . import xmltree
 
 import logging
 logger = logging.getLogger(__name__)
@@ -45,11 +54,13 @@ NEW_EVENT_PARAMETERS = True
 if sys.version_info[0] < 3:
     def str23compat(item):
         return unicode(str(item))
-    XML_ENCODING=""
 else:
     def str23compat(item):
         return str(item)
-    XML_ENCODING="unicode"
+
+# The XML tree implementation, selected at startup
+TREE = xmltree.getBackend(GlobalSettings.xmlBackend)
+ET = TREE.ET
 
 class NameSpace(object):
     def __init__(self, namespace, url):
@@ -88,7 +99,14 @@ NAMESPACES.update(NS_2IMMERSE_COMPONENT.ns())
 NAMESPACES.update(NS_TRIGGER.ns())
 NAMESPACES.update(NS_AUTH.ns())
 for k, v in list(NAMESPACES.items()):
-    ET.register_namespace(k, v)
+    TREE.registerNamespace(k, v)
+
+# DocumentXml methods that can be used in a batch
+BATCH_VERBS = {'paste', 'cut', 'copy', 'move', 'modifyAttributes', 'modifyData'}
+# DocumentEvents methods that can be used in a batch
+EVENT_BATCH_VERBS = {'trigger', 'enqueue', 'dequeue', 'modify'}
+# Number of versions of the events list kept, so clients that missed broadcasts can get the changes
+EVENTS_HISTORY = 32
 
 # regular expression to decompose xml:id fields that end in a -number
 FIND_ID_INDEX = re.compile(r'(.+)-([0-9]+)')
@@ -96,71 +114,321 @@ FIND_NAME_INDEX = re.compile(r'(.+) \(([0-9]+)\)')
 FIND_PATH_ATTRIBUTE = re.compile(r'(.+)/@([a-zA-Z0-9_\-.:]+)')
 
 
+def _splitIndex(pattern, value):
+    """Decompose an xml:id or tt:name into base and numeric suffix (0 if there is none)"""
+    match = pattern.match(value)
+    if match:
+        return match.group(1), int(match.group(2))
+    return value, 0
+
+# regular expressions to decompose purely structural XPaths (as returned by _getXPath) into steps
+FIND_PATH_STEP = re.compile(r'(\{[^}]*\}[a-zA-Z_][a-zA-Z0-9_\-.]*|[a-zA-Z_][a-zA-Z0-9_\-.]*(?::[a-zA-Z_][a-zA-Z0-9_\-.]*)?)(?:\[([0-9]+)\])?')
+FIND_STRUCTURAL_PATH = re.compile(r'^[^@=()\'"]*$')
+
+# Cache of XPaths compiled by _compilePath
+_compiledPaths = {}
+MAX_COMPILED_PATHS = 10000
+
+
+def _compilePath(path):
+    """Decompose a structural XPath into (absolute, [(tag, ordinal), ...]), or None if it is not structural"""
+    if path in _compiledPaths:
+        return _compiledPaths[path]
+    rv = None
+    absolute = path[:1] == '/'
+    steps = []
+    pos = 1 if absolute else 0
+    while pos < len(path):
+        match = FIND_PATH_STEP.match(path, pos)
+        if not match:
+            steps = None
+            break
+        tag = match.group(1)
+        if ':' in tag and tag[:1] != '{':
+            ns, rest = tag.split(':')
+            if ns not in NAMESPACES:
+                steps = None
+                break
+            tag = '{%s}%s' % (NAMESPACES[ns], rest)
+        ordinal = match.group(2)
+        if ordinal is not None:
+            ordinal = int(ordinal)
+        steps.append((tag, ordinal))
+        pos = match.end()
+        if pos < len(path):
+            if path[pos] != '/':
+                steps = None
+                break
+            pos += 1
+            if pos == len(path):
+                steps = None
+                break
+    if steps:
+        rv = (absolute, steps)
+    if len(_compiledPaths) >= MAX_COMPILED_PATHS:
+        _compiledPaths.clear()
+    _compiledPaths[path] = rv
+    return rv
+
+# Cache of attribute value templates compiled by _compileAVT
+_compiledAVTs = {}
+MAX_COMPILED_AVTS = 10000
+
+
+def _compileAVT(value):
+    """Decompose an attribute value template into a tuple of (kind, text) tokens, or None if it has no {...}
+    expressions. kind is 'literal', 'clock' (text is '.' or '..'), 'value' or 'xpath'."""
+    if value in _compiledAVTs:
+        return _compiledAVTs[value]
+    tokens = []
+    pos = 0
+    for match in INTERPOLATION.finditer(value):
+        if match.start() > pos:
+            tokens.append(('literal', value[pos:match.start()]))
+        expr = value[match.start()+1:match.end()-1]
+        if expr == "tt:clock(.)":
+            tokens.append(('clock', '.'))
+        elif expr == "tt:clock(..)":
+            tokens.append(('clock', '..'))
+        elif expr == "tt:value()":
+            tokens.append(('value', None))
+        else:
+            # Presume it is an XPath expression leading to a variable in the document.
+            tokens.append(('xpath', expr))
+        pos = match.end()
+    rv = None
+    if tokens:
+        if pos < len(value):
+            tokens.append(('literal', value[pos:]))
+        rv = tuple(tokens)
+    if len(_compiledAVTs) >= MAX_COMPILED_AVTS:
+        _compiledAVTs.clear()
+    _compiledAVTs[value] = rv
+    return rv
+
+
 # Decorator: obtain self.lock during the operation
 def synchronized(method):
     """Annotate a mthod to use the object lock"""
+    @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
         with self.lock:
             return method(self, *args, **kwargs)
     return wrapper
 
 
+# Decorator: obtain self.lock in shared mode during the operation, for methods that do not modify the document
+def shared(method):
+    """Annotate a method to use the object lock in shared mode (concurrently with other shared methods)"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.shared():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 # Decorator: obtain self.lock during the operation, and record all edits
 def edit(method):
-    """Annotate a mthod to use the object lock and record the results."""
+    """Annotate a mthod to use the object lock and record the results. Edits wait for their turn in the
+    document edit queue. An edit done as part of another one (or of a transaction) is recorded with it."""
+    @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
-        with self.lock:
-            ok = self.document._startListening(method.__name__)
-            if not ok:
-                self.logger.error('edit(%s): another edit operation is still in progress' % method.__name__, extra=self.getLoggerExtra())
-                self.document.setError("Another editing operation is still in progress")
-                abort(400, "Another editing operation is still in progress")
-            toForward = None
-            try:
-                rv = method(self, *args, **kwargs)
-            finally:
+        with self.document._editTurn(method.__name__):
+            with self.lock:
+                if self.document.undoLog is not None or self.document.editManager is not None:
+                    # Part of a transaction or another edit, which records and forwards the edits when it is done
+                    return method(self, *args, **kwargs)
+                self.document._startListening(method.__name__)
+                try:
+                    rv = method(self, *args, **kwargs)
+                except:
+                    self.document._stopListening(discard=True)
+                    raise
                 toForward = self.document._stopListening()
-        if toForward:
-            self.document._forwardToOthers(toForward)
+            # Forward before the next edit gets its turn, so the changes are forwarded in order
+            if toForward:
+                self.document._forwardToOthers(toForward)
         return rv
     return wrapper
 
 
+def _applyAttributes(attrs, changed):
+    """Return attribute dict attrs with the changes (None values meaning removal) applied"""
+    rv = dict(attrs)
+    for k, v in changed.items():
+        if v is None:
+            rv.pop(k, None)
+        else:
+            rv[k] = v
+    return rv
+
+
+def _checkArguments(method, args):
+    """Return None if method can be called with keyword arguments args, otherwise the reason why not"""
+    try:
+        inspect.signature(method).bind(**args)
+    except TypeError as e:
+        return str(e)
+    return None
+
+
+def _eventsDelta(old, new):
+    """Return the differences between two results of DocumentEvents.get (old may be None)"""
+    oldEvents = {}
+    if old is not None:
+        oldEvents = dict((event['id'], event) for event in old['events'])
+    added = []
+    changed = []
+    for event in new['events']:
+        oldEvent = oldEvents.pop(event['id'], None)
+        if oldEvent is None:
+            added.append(event)
+        elif oldEvent is not event and oldEvent != event:
+            changed.append(event)
+    return dict(
+        remote=new['remote'],
+        added=added,
+        changed=changed,
+        removed=list(oldEvents.keys()),
+        order=[event['id'] for event in new['events']]
+    )
+
+
 class EditManager(object):
     """Helper class to collect sets of operations, sort of a simplified transaction mechanism"""
     def __init__(self, document, reason=None):
         self.document = document
         self.reason = reason
         self.commandList = []
+        self.elementList = []  # The element each command applies to, for compacting
+        # A Document in this process can paste a copy of an added element, anything else needs its XML
+        self.inProcess = isinstance(document.forwardHandler, Document)
         self.document.lock.acquire()
 
+    def _command(self, verb, anchor, useId=True, **kwargs):
+        """Return a command for anchor, identified by its path and (if it has one) its xml:id"""
+        command = dict(verb=verb, path=self.document._getXPath(anchor), **kwargs)
+        id = anchor.get(NS_XML('id'))
+        if id and useId:
+            command['id'] = id
+        return command
+
     def add(self, element, parent):
         """Called just after an element subtree has been added to its parent.
-        At time of call, the element is already present in the tree."""
-        content = ET.tostring(element, encoding=XML_ENCODING)
-        parentPos = list(parent).index(element)
+        At time of call, the element is already present in the tree.
+        The command gets the XML data of the element, or a copy of the element when forwarding in-process."""
+        if self.inProcess:
+            content = dict(element=copy.deepcopy(element))
+        else:
+            content = dict(data=TREE.tostring(element))
+        parentPos = self.document._getChildPosition(element)
         if parentPos > 0:
             prevSibling = parent[parentPos-1]
-            self.commandList.append(dict(verb='add', path=self.document._getXPath(prevSibling), where='after', data=content))
+            self.commandList.append(self._command('add', prevSibling, where='after', **content))
         else:
-            self.commandList.append(dict(verb='add', path=self.document._getXPath(parent), where='begin', data=content))
+            self.commandList.append(self._command('add', parent, where='begin', **content))
+        self.elementList.append(element)
 
     def delete(self, element, parent):
         """Called just before an element is about to be deleted.
         At time of call, the element is still present in the tree."""
-        self.commandList.append(dict(verb='delete', path=self.document._getXPath(element)))
-
-    def change(self, elt):
-        """Called when the attributes of an element have been changed."""
-        self.commandList.append(dict(verb='change', path=self.document._getXPath(elt), attrs=json.dumps(elt.attrib)))
+        self.commandList.append(self._command('delete', element))
+        self.elementList.append(element)
+
+    def change(self, elt, changed=None):
+        """Called when the attributes of an element have been changed. If changed is given only those
+        attributes are forwarded (as an update, None values meaning removal), otherwise all of them."""
+        # The receiver knows the element by its old xml:id, so a changed one cannot be used to find it
+        if changed is None:
+            self.commandList.append(self._command('change', elt, useId=False, attrs=dict(elt.attrib)))
+        elif changed:
+            self.commandList.append(self._command('update', elt, useId=not NS_XML('id') in changed, attrs=dict(changed)))
+        else:
+            return
+        self.elementList.append(elt)
 
     def commit(self):
-        """Close the edit manager and return its list of commands."""
-        rv = self.commandList
+        """Close the edit manager and return its (compacted) list of commands."""
+        rv = self._compact()
+        for command in rv:
+            if command['verb'] in {'change', 'update'}:
+                command['attrs'] = json.dumps(command['attrs'])
         self.commandList = None
+        self.elementList = None
         self.document.lock.release()
         return rv
 
+    def _compact(self):
+        """Return the list of commands without redundant ones. A change or update is merged into a later change
+        or update of the same element, dropped if the element is deleted later, and folded into the add of the
+        element if there is one. An add that is directly followed by a delete of the same element is dropped
+        together with the delete.
+        Changes do not alter the tree structure, so the paths of the remaining commands stay valid."""
+        # Backwards: keep only the last change of an element, and none if it is deleted afterwards
+        later = {}
+        commands = []
+        for command, elt in zip(reversed(self.commandList), reversed(self.elementList)):
+            verb = command['verb']
+            if verb == 'add':
+                later.pop(elt, None)
+            elif verb == 'delete':
+                later[elt] = command
+            else:
+                laterCommand = later.get(elt)
+                if laterCommand is not None:
+                    self._mergeChange(command, laterCommand)
+                    continue
+                later[elt] = command
+            commands.append((command, elt))
+        commands.reverse()
+        # Forwards: fold changes into adds, and cancel add/delete pairs
+        rv = []
+        addCommands = {}
+        for command, elt in commands:
+            verb = command['verb']
+            if verb == 'add':
+                addCommands[elt] = command
+            elif verb in {'change', 'update'} and elt in addCommands:
+                self._foldChange(addCommands[elt], command)
+                continue
+            elif verb == 'delete':
+                addCommands.pop(elt, None)
+                if rv and rv[-1][0]['verb'] == 'add' and rv[-1][1] is elt:
+                    rv.pop()
+                    continue
+            rv.append((command, elt))
+        return [command for command, _ in rv]
+
+    def _mergeChange(self, command, laterCommand):
+        """Merge change or update command into laterCommand, for the same element"""
+        if not 'id' in command:
+            # The earlier command may have changed the xml:id
+            laterCommand.pop('id', None)
+        if laterCommand['verb'] == 'delete' or laterCommand['verb'] == 'change':
+            return
+        if command['verb'] == 'change':
+            laterCommand['verb'] = 'change'
+            laterCommand['attrs'] = _applyAttributes(command['attrs'], laterCommand['attrs'])
+        else:
+            attrs = dict(command['attrs'])
+            attrs.update(laterCommand['attrs'])
+            laterCommand['attrs'] = attrs
+
+    def _foldChange(self, addCommand, command):
+        """Apply a change or update command to the element added by addCommand"""
+        element = addCommand.get('element')
+        if element is None:
+            element = TREE.fromstring(addCommand['data'])
+        if command['verb'] == 'change':
+            attrs = command['attrs']
+        else:
+            attrs = _applyAttributes(dict(element.attrib), command['attrs'])
+        element.attrib.clear()
+        for k, v in attrs.items():
+            element.set(k, v)
+        if 'data' in addCommand:
+            addCommand['data'] = TREE.tostring(element)
+
 
 class Document(object):
     def __init__(self, documentId):
@@ -170,12 +438,30 @@ class Document(object):
         self.tree = None
         self.url = None
         self.base = None
-        self.documentElement = None  # Nasty trick to work around elementtree XPath incompleteness
+        self.documentElement = None  # Document node for absolute XPaths, see xmltree
         self.baseAdded = False  # True if tim:base attribute was added by us
         # Data strcutures for mapping over the tree
         self.parentMap = None
         self.idMap = None
         self.nameSet = None
+        # Highest -N suffix of xml:id and (N) suffix of tt:name in use, per base
+        self.idCounters = None
+        self.nameCounters = None
+        # Positional index: element -> (position in parent, xpath step), and
+        # parent -> (number of leading children indexed, per-tag counts of those children, xpath step -> child)
+        self.positionIndex = None
+        self.positionValid = None
+        # Results of non-positional XPath lookups, valid while structureGeneration is unchanged
+        self.pathCache = None
+        self.pathCacheGeneration = None
+        self.structureGeneration = 0
+        # Incremented whenever anything in the tree changes, for caches of serialized data
+        self.contentVersion = 0
+        # Secondary indexes (dictionaries used as sets), maintained by _indexElement and _unindexElement:
+        # tt:events and tt:completeEvents containers by tag, children of tl:par with tls:state, elements by au:type
+        self.eventContainerIndex = None
+        self.activeIndex = None
+        self.typeIndex = None
         # handlers for the different views on the document
         self.eventsHandler = None
         self.authoringHandler = None
@@ -186,15 +472,23 @@ class Document(object):
         self.settingsHandler = None
         self.asyncHandler = None
         self.editingHandler = None
-        self.lock = threading.RLock()
+        self.schedulerHandler = None
+        self.lock = rwlock.RWLock()
+        self.editQueue = rwlock.EditQueue(GlobalSettings.editQueueDepth, GlobalSettings.editTimeout)
+        self.handlerLock = threading.RLock()  # Protects lazy creation of the handlers, which can happen under a shared lock
+        self.indexLock = threading.Lock()  # Protects lazy updates of positionIndex, which can happen under a shared lock
+        self.cacheLock = threading.Lock()  # Protects filling the lookup caches (paths, event descriptions), which can happen under a shared lock
         self.editManager = None
+        self.undoLog = None  # List of (function, args) to roll back the current transaction, if one is active
+        self.commitActions = None  # Functions to call once the current transaction has been committed and forwarded
+        self.unforwardedEdits = 0  # Number of edits whose operations have been recorded but not forwarded yet
         self.companionTimelineIsActive = False  # Mainly for warning triggertool operator if it is not
         self.lastErrorMessage = None
         self.logger = logger
         self.timeOpened = time.time()
         self.description = ''
         self._setDescription()
-        self.clock = clocks.PausableClock(clocks.SystemClock())
+        self.clock = clocks.CallbackPausableClock(clocks.SystemClock())
         self._loggerExtra = dict(subSource='document', documentID=documentId)
         self.logger.info('created document %s' % documentId)
 
@@ -230,31 +524,69 @@ class Document(object):
                 self.load(request.args['url'])
                 return ''
         else:
-            return Response(ET.tostring(self._prepareForSave(), encoding=XML_ENCODING), mimetype="application/xml")
+            return Response(self._serializeForSave(), mimetype="application/xml")
 
     @synchronized
-    def _documentLoaded(self):
-        """Creates paremtMap and idMap and various other data structures after loading a document."""
-        self.parentMap = {c: p for p in self.tree.iter() for c in p}
-        # Workaround for XPath nastiness in ET: it does not handle / correctly so we help it a bit.
-        self.documentElement = ET.Element('')
-        self.documentElement.append(self.tree.getroot())
+    def _parseDocument(self, fp):
+        """Parse a document from a file-like object into self.tree. Creates parentMap and idMap and various other
+        data structures once the parse has succeeded, so a parse error leaves the current document untouched.
+        Returns the list of elements that need an xml:id because they want status."""
+        elements = []
+        stack = []
+        root = None
+        for event, e in TREE.iterparse(fp):
+            if event == 'end':
+                stack.pop()
+                continue
+            if stack:
+                elements.append((e, stack[-1]))
+            else:
+                root = e
+                elements.append((e, None))
+            stack.append(e)
+        self.parentMap = {}
+        self.positionIndex = {}
+        self.positionValid = {}
+        self._invalidateEventCaches(None)
+        self.structureGeneration += 1
+        self.contentVersion += 1
         self.idMap = {}
-        self.nameSet = set()
-        for e in self.tree.iter():
+        self.nameSet = collections.Counter()
+        self.idCounters = {}
+        self.nameCounters = {}
+        self.eventContainerIndex = {NS_TRIGGER('events'): {}, NS_TRIGGER('completeEvents'): {}}
+        self.activeIndex = {}
+        self.typeIndex = {}
+        wantStatus = []
+        for e, parent in elements:
+            if parent is not None:
+                self.parentMap[e] = parent
             id = e.get(NS_XML('id'))
             if id:
                 self.idMap[id] = e
+                self._idUsed(id)
             name = e.get(NS_TRIGGER('name'))
             if name:
-                self.nameSet.add(name)
+                self._nameAdded(name)
+            self._indexElement(e)
+            # Parents of tt:events want status updates from the timeline service
+            if e.tag == NS_TRIGGER('events') and parent is not None:
+                parent.set(NS_TRIGGER("wantstatus"), "true")
+                if not parent in wantStatus:
+                    wantStatus.append(parent)
+        self.tree = ET.ElementTree(root)
+        return wantStatus
+
+    @synchronized
+    def _documentLoaded(self, wantStatus):
+        """Finish the data structures after _parseDocument has loaded a document."""
+        self.documentElement = TREE.documentElement(self.tree.getroot())
         # Add attributes and elements that we need (mainly to communicate with the preview player timeline service)
         firstRootChild = list(self.tree.getroot())[0]
         firstRootChild.set(NS_TRIGGER("wantstatus"), "true")
         self._ensureId(firstRootChild)
         self._ensureId(self.tree.getroot())
-        for elt in self.tree.getroot().findall('.//tt:events/..', NAMESPACES):
-            elt.set(NS_TRIGGER("wantstatus"), "true")
+        for elt in wantStatus:
             self._ensureId(elt)
 
     @synchronized
@@ -263,16 +595,65 @@ class Document(object):
         id = elt.get(NS_XML("id"))
         if id:
             return
-        id = 'ttadded'
-        while id in self.idMap:
-            match = FIND_ID_INDEX.match(id)
-            if match:
-                num = int(match.group(2))
-                id = match.group(1) + '-' + str23compat(num+1)
-            else:
-                id = id + '-1'
+        id = self._uniqueId('ttadded')
         elt.set(NS_XML("id"), id)
         self.idMap[id] = elt
+        self.contentVersion += 1
+
+    def _idUsed(self, id):
+        """Record the suffix of an xml:id that is in use, for _uniqueId"""
+        base, num = _splitIndex(FIND_ID_INDEX, id)
+        if num > self.idCounters.get(base, 0):
+            self.idCounters[base] = num
+
+    def _uniqueId(self, id):
+        """Return id if it is not in use, otherwise a new id with the next free -N suffix"""
+        if id not in self.idMap:
+            self._idUsed(id)
+            return id
+        base, num = _splitIndex(FIND_ID_INDEX, id)
+        num = max(num, self.idCounters.get(base, 0))
+        while True:
+            num += 1
+            id = base + '-' + str23compat(num)
+            if id not in self.idMap:
+                break
+        self.idCounters[base] = num
+        return id
+
+    def _nameAdded(self, name):
+        """Record a tt:name that is in use, for _uniqueName"""
+        self.nameSet[name] += 1
+        base, num = _splitIndex(FIND_NAME_INDEX, name)
+        if num > self.nameCounters.get(base, 0):
+            self.nameCounters[base] = num
+
+    def _nameRemoved(self, name):
+        """Release a tt:name that is no longer in use"""
+        if self.nameSet[name] <= 1:
+            self.nameSet.pop(name, None)
+        else:
+            self.nameSet[name] -= 1
+
+    def _uniqueName(self, name):
+        """Return name if it is not in use, otherwise a new name with the next free (N) suffix"""
+        if name not in self.nameSet:
+            return name
+        base, num = _splitIndex(FIND_NAME_INDEX, name)
+        num = max(num, self.nameCounters.get(base, 0))
+        while True:
+            num += 1
+            name = base + ' (' + str23compat(num) + ')'
+            if name not in self.nameSet:
+                break
+        self.nameCounters[base] = num
+        return name
+
+    def _invalidateEventCaches(self, elt, stateOnly=False):
+        """Tell the events handler (if any) that elt changed (only its tls: attributes if stateOnly),
+        or the whole document if elt is None"""
+        if self.eventsHandler:
+            self.eventsHandler._invalidateCaches(elt, stateOnly)
 
     @synchronized
     def _elementAdded(self, elt, parent, recursive=False):
@@ -280,18 +661,33 @@ class Document(object):
         Returns edit operation which can be forwarded to slaved documents."""
         assert elt not in self.parentMap
         self.parentMap[elt] = parent
+        if not recursive:
+            self._invalidateEventCaches(elt)
+            self._positionsAdded(elt, parent)
+            self.structureGeneration += 1
+            self.contentVersion += 1
         id = elt.get(NS_XML('id'))
         if id:
             assert id not in self.idMap
             self.idMap[id] = elt
+            self._idUsed(id)
         name = elt.get(NS_TRIGGER('name'))
         if name:
-            self.nameSet.add(name)
+            self._nameAdded(name)
+        self._indexElement(elt)
         for ch in elt:
             self._elementAdded(ch, elt, True)
         if not recursive and self.editManager:
             self.editManager.add(elt, parent)
 
+    @synchronized
+    def _removeElement(self, elt, parent):
+        """Remove elt from parent and update the data structures"""
+        # Make sure the position is known, so the deletion can still be described after the element is gone
+        self._getPositionEntry(elt, parent)
+        parent.remove(elt)
+        self._elementDeleted(elt)
+
     @synchronized
     def _elementDeleted(self, elt, recursive=False):
         """Updates parentMap and idMap and various other data structures after an element is deleted.
@@ -299,13 +695,22 @@ class Document(object):
         parent = self.parentMap[elt]
         if not recursive and self.editManager:
             self.editManager.delete(elt, parent)
+        self._invalidateEventCaches(elt)
         del self.parentMap[elt]
         assert elt not in parent
+        if not recursive:
+            self._positionsDeleted(elt, parent)
+            self.structureGeneration += 1
+            self.contentVersion += 1
+        self.positionIndex.pop(elt, None)
+        self.positionValid.pop(elt, None)
         id = elt.get(NS_XML('id'))
         if id and id in self.idMap:
             del self.idMap[id]
-        # We do not remove tt:name, it may occur multiple times so we are not
-        # sure it has really disappeared
+        self._unindexElement(elt)
+        name = elt.get(NS_TRIGGER('name'))
+        if name:
+            self._nameRemoved(name)
         toDelete = [ch for ch in elt]
 
         for ch in toDelete:
@@ -313,11 +718,98 @@ class Document(object):
             self._elementDeleted(ch, recursive=True)
 
     @synchronized
-    def _elementChanged(self, elt):
-        """Called when element attributes have changed.
+    def _elementChanged(self, elt, changed=None, oldId=None):
+        """Called when element attributes have changed. changed maps the attributes that were set to
+        their new value (None for removed attributes), if not given all attributes may have changed.
+        oldId is the xml:id the element had before the change, if that may have changed.
         Returns edit operation which can be forwarded to slaved documents."""
+        self.contentVersion += 1
+        self._invalidateEventCaches(elt)
+        self._unindexElement(elt)
+        self._indexElement(elt)
+        if changed is None or NS_XML('id') in changed:
+            self._reindexId(elt, oldId)
         if self.editManager:
-            self.editManager.change(elt)
+            self.editManager.change(elt, changed)
+
+    def _reindexId(self, elt, oldId):
+        """Update idMap after the xml:id of elt may have changed from oldId"""
+        if oldId and self.idMap.get(oldId) is elt:
+            del self.idMap[oldId]
+        id = elt.get(NS_XML('id'))
+        if id:
+            self.idMap[id] = elt
+
+    @synchronized
+    def _elementStateChanged(self, elt):
+        """Called when the tls: attributes of an element have been changed by the timeline service."""
+        self.contentVersion += 1
+        self._invalidateEventCaches(elt, stateOnly=True)
+        self._unindexElement(elt)
+        self._indexElement(elt)
+
+    def _dataChanged(self, elt):
+        """Called when the text or tail of an element has changed."""
+        self.contentVersion += 1
+        self._invalidateEventCaches(elt)
+
+    def _indexElement(self, elt):
+        """Add an in-tree element to the secondary indexes"""
+        if elt.tag in self.eventContainerIndex:
+            self.eventContainerIndex[elt.tag][elt] = None
+        if NS_TIMELINE_INTERNAL('state') in elt.attrib:
+            parent = self.parentMap.get(elt)
+            if parent is not None and parent.tag == NS_TIMELINE('par'):
+                self.activeIndex[elt] = None
+        auType = elt.get(NS_AUTH('type'))
+        if auType:
+            self.typeIndex.setdefault(auType, {})[elt] = None
+
+    def _unindexElement(self, elt):
+        """Remove an element from the secondary indexes"""
+        if elt.tag in self.eventContainerIndex:
+            self.eventContainerIndex[elt.tag].pop(elt, None)
+        self.activeIndex.pop(elt, None)
+        for elements in self.typeIndex.values():
+            elements.pop(elt, None)
+
+    def _getDocumentOrderKey(self, elt):
+        """Return a sort key that orders elements in document order"""
+        rv = []
+        parent = self._getParent(elt)
+        while parent is not None:
+            rv.append(self._getPositionEntry(elt, parent)[0])
+            elt = parent
+            parent = self._getParent(elt)
+        rv.reverse()
+        return rv
+
+    @shared
+    def _getEventContainers(self, tag):
+        """Return all tt:events or tt:completeEvents elements, in document order"""
+        return sorted(self.eventContainerIndex[tag], key=self._getDocumentOrderKey)
+
+    @shared
+    def _getEventElements(self, tag):
+        """Return children with a tt:name of all tt:events or tt:completeEvents elements, in document order"""
+        rv = []
+        for container in self._getEventContainers(tag):
+            rv += [elt for elt in container if NS_TRIGGER('name') in elt.attrib]
+        return rv
+
+    @shared
+    def _getActiveElements(self):
+        """Return children of tl:par elements that have a tt:name and a tls:state, grouped per parent, in document order"""
+        rv = [elt for elt in self.activeIndex if NS_TRIGGER('name') in elt.attrib]
+        def parentOrderKey(elt):
+            parent = self.parentMap[elt]
+            return (self._getDocumentOrderKey(parent), self._getPositionEntry(elt, parent)[0])
+        return sorted(rv, key=parentOrderKey)
+
+    @shared
+    def _getElementsByType(self, auType):
+        """Return all elements with the given au:type, in document order"""
+        return sorted(self.typeIndex.get(auType, {}), key=self._getDocumentOrderKey)
 
     def _afterCopy(self, elt, triggerAttributes=False):
         """Adjust element attributes (xml:id and tt:name) after a copy.
@@ -334,84 +826,115 @@ class Document(object):
                     id = 'new'
                 else:
                     continue
-            while id in self.idMap:
-                match = FIND_ID_INDEX.match(id)
-                if match:
-                    num = int(match.group(2))
-                    id = match.group(1) + '-' + str23compat(num+1)
-                else:
-                    id = id + '-1'
-            e.set(NS_XML('id'), id)
+            e.set(NS_XML('id'), self._uniqueId(id))
         # Specific to tt: events
         if triggerAttributes:
             name = elt.get(NS_TRIGGER('name'), 'New')
             if name:
-                while name in self.nameSet:
-                    match = FIND_NAME_INDEX.match(name)
-                    if match:
-                        num = int(match.group(2))
-                        name = match.group(1) + ' (' + str23compat(num+1) + ')'
-                    else:
-                        name = name + ' (1)'
-                elt.set(NS_TRIGGER('name'), name)
+                elt.set(NS_TRIGGER('name'), self._uniqueName(name))
             # Flag the new element as being newly copied (so it'll show up in the active list)
             elt.set(NS_TIMELINE_INTERNAL("state"), "new")
 
-    @synchronized
     def events(self):
         """Returns the events handler (after creating it if needed)"""
         if not self.eventsHandler:
-            self.eventsHandler = DocumentEvents(self)
+            with self.handlerLock:
+                if not self.eventsHandler:
+                    self.eventsHandler = DocumentEvents(self)
         return self.eventsHandler
 
-    @synchronized
     def authoring(self):
         """Returns the authoring handler (after creating it if needed)"""
         if not self.authoringHandler:
-            self.authoringHandler = DocumentAuthoring(self)
+            with self.handlerLock:
+                if not self.authoringHandler:
+                    self.authoringHandler = DocumentAuthoring(self)
         return self.authoringHandler
 
-    @synchronized
     def serve(self):
         """Returns the serve handler (after creating it if needed)"""
         if not self.serveHandler:
-            self.serveHandler = DocumentServe(self)
+            with self.handlerLock:
+                if not self.serveHandler:
+                    self.serveHandler = DocumentServe(self)
         return self.serveHandler
 
-    @synchronized
     def xml(self):
         """Returns the xml handler (after creating it if needed)"""
         if not self.xmlHandler:
-            self.xmlHandler = DocumentXml(self)
+            with self.handlerLock:
+                if not self.xmlHandler:
+                    self.xmlHandler = DocumentXml(self)
         return self.xmlHandler
 
-    @synchronized
     def remote(self):
         """Returns the remote control handler (after creating it if needed)"""
         if not self.remoteHandler:
-            self.remoteHandler = DocumentRemote(self)
+            with self.handlerLock:
+                if not self.remoteHandler:
+                    self.remoteHandler = DocumentRemote(self)
         return self.remoteHandler
 
-    @synchronized
     def settings(self):
         """Returns the asynchronous (socketIO) update handler (after creating it if needed)"""
         if not self.settingsHandler:
-            self.settingsHandler = DocumentSettings(self)
+            with self.handlerLock:
+                if not self.settingsHandler:
+                    self.settingsHandler = DocumentSettings(self)
         return self.settingsHandler
 
-    @synchronized
     def asynch(self):
         """Returns the document settings handler (after creating it if needed)"""
         if not self.asyncHandler:
-            self.asyncHandler = DocumentAsync(self)
+            with self.handlerLock:
+                if not self.asyncHandler:
+                    self.asyncHandler = DocumentAsync(self)
         return self.asyncHandler
 
+    def scheduler(self):
+        """Returns the handler for scheduled triggers (after creating it if needed)"""
+        if not self.schedulerHandler:
+            with self.handlerLock:
+                if not self.schedulerHandler:
+                    self.schedulerHandler = DocumentScheduler(self)
+        return self.schedulerHandler
+
+    def _clockChanged(self):
+        """Called when the document clock may have been started, stopped or moved"""
+        if self.schedulerHandler:
+            self.schedulerHandler.wakeup()
+
+    @shared
     def editing(self):
         """Returns a document editing handler (after creating it if needed)"""
         if not self.editingHandler:
-            self.editingHandler = DocumentEditing(self)
+            with self.handlerLock:
+                if not self.editingHandler:
+                    self.editingHandler = DocumentEditing(self)
         return self.editingHandler
 
+    @contextlib.contextmanager
+    def _editTurn(self, reason):
+        """Wait in the edit queue until it is our turn to edit. Not needed (and not done) if we hold the lock
+        already, i.e. when nested in another operation on the document."""
+        if self.lock.heldExclusively():
+            yield
+            return
+        try:
+            self.editQueue.enter()
+        except rwlock.EditQueueFull:
+            self.logger.error('%s: too many edit operations waiting' % reason, extra=self.getLoggerExtra())
+            self.setError("Too many editing operations waiting")
+            abort(503, "Too many editing operations waiting")
+        except rwlock.EditQueueTimeout:
+            self.logger.error('%s: timeout waiting for other edit operations' % reason, extra=self.getLoggerExtra())
+            self.setError("Timeout waiting for other editing operations")
+            abort(503, "Timeout waiting for other editing operations")
+        try:
+            yield
+        finally:
+            self.editQueue.leave()
+
     @synchronized
     def _startListening(self, reason=None):
         """Start recording edit operations. Returns success indicator."""
@@ -423,38 +946,159 @@ class Document(object):
         return True
 
     @synchronized
-    def _stopListening(self):
+    def _stopListening(self, discard=False):
+        """Stop recording edit operations. Returns the operations, which the caller must pass to
+        _forwardToOthers, unless discard is true."""
         commands = None
         with self.lock:
             if self.editManager:
                 commands = self.editManager.commit()
                 self.editManager = None
+            if discard:
+                return None
+            if commands:
+                self.unforwardedEdits += 1
         return commands
 
+    @synchronized
+    def _startTransaction(self, reason):
+        """Start a transaction: a set of edits that is forwarded as one, or rolled back if it fails.
+        Returns success indicator."""
+        if self.undoLog is not None or not self._startListening(reason):
+            return False
+        self.undoLog = []
+        self.commitActions = []
+        return True
+
+    @synchronized
+    def _commitTransaction(self):
+        """End a transaction, returns the edit operations to forward"""
+        self.undoLog = None
+        self.commitActions = None
+        return self._stopListening()
+
+    @synchronized
+    def _rollbackTransaction(self):
+        """Undo all edits of the current transaction. They are not forwarded."""
+        undoLog = self.undoLog
+        self.undoLog = None
+        self.commitActions = None
+        try:
+            for func, args in reversed(undoLog):
+                func(*args)
+        finally:
+            self._stopListening(discard=True)
+
+    def _afterCommit(self, func):
+        """Call func now, or if a transaction is active once it has been committed and forwarded (only once,
+        however often this is called). Nothing is called for a transaction that is rolled back."""
+        if self.commitActions is None:
+            func()
+        elif not func in self.commitActions:
+            self.commitActions.append(func)
+
+    def _batch(self, handler, verbs, steps, kind):
+        """Apply a list of steps as a single edit. Each step is a dict with a verb (one of verbs) and the arguments
+        for that method of handler. Either all steps are done and forwarded as one set of changes, or none are.
+        kind names the steps in error messages. Returns the list of results, with elements serialized."""
+        with self._editTurn('batch'):
+            with self.lock:
+                if not self._startTransaction('batch'):
+                    handler.logger.error('batch: another edit operation is still in progress', extra=self.getLoggerExtra())
+                    self.setError("Another editing operation is still in progress")
+                    abort(400, "Another editing operation is still in progress")
+                try:
+                    rv = [self._batchStep(handler, verbs, step, kind) for step in steps]
+                except:
+                    self._rollbackTransaction()
+                    raise
+                commitActions = self.commitActions
+                toForward = self._commitTransaction()
+            self._forwardToOthers(toForward)
+        for func in commitActions:
+            func()
+        return rv
+
+    def _batchStep(self, handler, verbs, step, kind):
+        args = dict(step)
+        verb = args.pop('verb', None)
+        if not verb in verbs:
+            self.setError('Unknown batch %s %s' % (kind, verb))
+            abort(400, 'Unknown batch %s %s' % (kind, verb))
+        method = getattr(handler, verb)
+        error = _checkArguments(method, args)
+        if error:
+            self.setError('Bad arguments for batch %s %s: %s' % (kind, verb, error))
+            abort(400, 'Bad arguments for batch %s %s: %s' % (kind, verb, error))
+        rv = method(**args)
+        if TREE.isElement(rv):
+            rv = TREE.tostring(rv)
+        return rv
+
+    def _recordUndo(self, func, *args):
+        """Remember how to undo an edit, if a transaction is active"""
+        if self.undoLog is not None:
+            self.undoLog.append((func, args))
+
+    def _undoAdded(self, elt):
+        self._removeElement(elt, self._getParent(elt))
+
+    def _undoDeleted(self, elt, parent, pos, subtree):
+        # _elementDeleted has emptied the subtree, so put the children back first
+        for e, children in subtree:
+            e[:] = children
+        parent.insert(pos, elt)
+        self._elementAdded(elt, parent)
+
+    def _undoChanged(self, elt, attrib):
+        oldId = elt.get(NS_XML('id'))
+        elt.attrib.clear()
+        elt.attrib.update(attrib)
+        self._elementChanged(elt, oldId=oldId)
+
+    def _undoDataChanged(self, elt, text, tail):
+        elt.text = text
+        elt.tail = tail
+        self._dataChanged(elt)
+
+    def _undoReplaced(self, elt, attrib, text, tail, children):
+        elt.clear()
+        elt[:] = children
+        elt.text = text
+        elt.tail = tail
+        self._structureChanged(elt)
+        self._undoChanged(elt, attrib)
+
     def _forwardToOthers(self, commands):
         if commands:
             assert self.forwardHandler
+            with self.lock:
+                self.unforwardedEdits -= 1
             self.forwardHandler.forward(commands)
 
     def forward(self, commands):
         self.logger.debug('forward %d commands' % len(commands), extra=self.getLoggerExtra())
         with self.lock:
             self._startListening('Document.forward()')
+            xml = self.xml()
             for command in commands:
                 cmd = command['verb']
-                del command['verb']
+                element = self._getCommandElement(command)
                 if cmd == 'add':
-                    path = command['path']
-                    where = command['where']
-                    data = command['data']
-                    self.xml().paste(path=path, where=where, data=data, mimetype='application/xml')
+                    if 'element' in command:
+                        # Forwarded in-process: copy the element instead of parsing its XML
+                        xml._paste(element, command['where'], None, copy.deepcopy(command['element']), 'application/x-python-object')
+                    else:
+                        xml._paste(element, command['where'], None, command['data'], 'application/xml')
                 elif cmd == 'delete':
-                    path = command['path']
-                    self.xml().cut(path=path)
+                    xml._cut(element, 'application/x-python-object')
                 elif cmd == 'change':
-                    path = command['path']
-                    attrs = command['attrs']
-                    self.xml().modifyAttributes(path=path, attrs=attrs, mimetype='application/json')
+                    # The command has the complete set of attributes, so the others are removed
+                    attrs = dict.fromkeys(element.attrib)
+                    attrs.update(json.loads(command['attrs']))
+                    xml._modifyAttributes(element, attrs, 'application/x-python-object')
+                elif cmd == 'update':
+                    xml._modifyAttributes(element, command['attrs'], 'application/json')
                 else:
                     assert 0, 'Unknown forward() verb: %s' % cmd
             toForward = self._stopListening()
@@ -463,16 +1107,24 @@ class Document(object):
     @synchronized
     def loadXml(self, data):
         self.logger.info('load xml (%d bytes)' % len(data), extra=self.getLoggerExtra())
-        self.url = None
-        self.base = None
-        self.baseAdded = False
+        if isinstance(data, bytes):
+            fp = io.BytesIO(data)
+        else:
+            fp = io.StringIO(data)
+        return self.loadStream(fp)
+
+    @synchronized
+    def loadStream(self, fp):
+        """Load a document from a file-like object, such as an uploaded file"""
         try:
-            root = ET.fromstring(data)
-        except ET.ParseError:
+            wantStatus = self._parseDocument(fp)
+        except TREE.ParseError:
             self.setError("XML parse error in document")
             abort(400, "XML parse error in document")
-        self.tree = ET.ElementTree(root)
-        self._documentLoaded()
+        self.url = None
+        self.base = None
+        self.baseAdded = False
+        self._documentLoaded(wantStatus)
         if self.tree.getroot().get(NS_2IMMERSE("base")):
             self.base = self.tree.getroot().get(NS_2IMMERSE("base"))
         return ''
@@ -480,16 +1132,18 @@ class Document(object):
     @synchronized
     def load(self, url):
         self.logger.info('load: %s' % url, extra=self.getLoggerExtra())
-        self.url = url
-        self.base = None
-        self.baseAdded = False
         fp = urllib.request.urlopen(url)
         try:
-            self.tree = ET.parse(fp)
-        except ET.ParseError:
+            wantStatus = self._parseDocument(fp)
+        except TREE.ParseError:
             self.setError("XML parse error in document")
             abort(400, "XML parse error in %s" % url)
-        self._documentLoaded()
+        finally:
+            fp.close()
+        self.url = url
+        self.base = None
+        self.baseAdded = False
+        self._documentLoaded(wantStatus)
         if self.tree.getroot().get(NS_2IMMERSE("base")):
             self.base = self.tree.getroot().get(NS_2IMMERSE("base"))
         else:
@@ -508,62 +1162,69 @@ class Document(object):
         filename = urllib.request.url2pathname(p.path)
         fp = open(filename, 'w')
         self._zapWhitespace()
-        saveTree = self._prepareForSave()
-        fp.write(ET.tostring(saveTree, encoding=XML_ENCODING))
+        fp.write(self._serializeForSave())
         fp.close()
         self.clearError()
 
     @synchronized
     def _zapWhitespace(self):
         """Temporary method: clear all non-relevant whitespace from the document before saving"""
+        self.contentVersion += 1
         for e in self.tree.getroot().iter():
             if e.text:
                 e.text = e.text.strip()
             if e.tail:
                 e.tail = e.tail.strip()
 
-    def _prepareForSave(self):
-        """Prepare tree for saving by removing all items we added"""
-        saveTree = copy.deepcopy(self.tree.getroot())
-        # Remove tim:base, if we added it
-        if self.baseAdded:
-            assert saveTree.get(NS_2IMMERSE("base"))
-            saveTree.attrib.pop(NS_2IMMERSE("base"))
-        for elt in saveTree.iter():
+    def _serializeForSave(self):
+        """Serialize the tree for saving, leaving out all items we added. Filters attributes while
+        serializing, so the (possibly large) tree is not copied."""
+        return TREE.tostringFiltered(self.tree.getroot(), self._getSaveAttributes)
+
+    def _getSaveAttributes(self, elt):
+        """Return the attributes of elt as they should be saved"""
+        realDur = elt.get(NS_TRIGGER("_realDur"))
+        isRoot = self.baseAdded and elt is self.tree.getroot()
+        rv = []
+        hasDur = False
+        for attr, value in elt.items():
+            # Remove all tls: attributes and tt:_realDur
+            if attr == NS_TRIGGER("_realDur") or attr in NS_TIMELINE_INTERNAL:
+                continue
+            # Remove tim:base, if we added it
+            if isRoot and attr == NS_2IMMERSE("base"):
+                continue
             # Copy tl:dur attribute from tt:_realDur
-            realDur = elt.get(NS_TRIGGER("_realDur"))
-            if realDur:
-                elt.set(NS_TIMELINE("dur"), realDur)
-            # Remove all tt: attributes
-            toRemove = []
-            for attr in list(elt.attrib.keys()):
-                if attr == NS_TRIGGER("_realDur"):
-                    toRemove.append(attr)
-                if attr in NS_TIMELINE_INTERNAL:
-                    toRemove.append(attr)
-            for attr in toRemove:
-                elt.attrib.pop(attr)
-        # Remove any elements we inserted
-        # xxxjack tbd
-        return saveTree
+            if realDur and attr == NS_TIMELINE("dur"):
+                value = realDur
+                hasDur = True
+            rv.append((attr, value))
+        if realDur and not hasDur:
+            rv.append((NS_TIMELINE("dur"), realDur))
+        return rv
 
-    @synchronized
+    def lockStatistics(self):
+        rv = self.lock.getStatistics()
+        rv['editQueue'] = self.editQueue.statistics.get()
+        return Response(json.dumps(rv), mimetype="application/json")
+
+    @shared
     def dump(self):
         return '%d elements' % self._count()
 
-    @synchronized
+    @shared
     def _count(self):
         totalCount = 0
         for _ in self.tree.iter():
             totalCount += 1
         return totalCount
 
-    @synchronized
+    @shared
     def _getParent(self, element):
         return self.parentMap.get(element, None)
 
     def _toET(self, tag, data, mimetype):
-        if isinstance(data, ET.Element):
+        if TREE.isElement(data):
             # Cop-out. It's an ElementTree object already
             assert tag is None
             assert mimetype == 'application/x-python-object'
@@ -577,7 +1238,7 @@ class Document(object):
             assert tag
             newElement = ET.Element(tag, data)
         elif mimetype == 'application/xml':
-            newElement = ET.fromstring(data)
+            newElement = TREE.fromstring(data)
         else:
             self.setError("Internal error: unexpected mimetype %s" % mimetype)
             abort(400, 'Unexpected mimetype %s' % mimetype)
@@ -590,36 +1251,163 @@ class Document(object):
             return element
         elif mimetype == 'application/json':
             assert len(list(element)) == 0
-            return json.dumps(element.attrib)
+            return json.dumps(dict(element.attrib))
         elif mimetype == 'application/xml':
-            return ET.tostring(element, encoding=XML_ENCODING)
+            return TREE.tostring(element)
+
+    def _indexChildren(self, parent):
+        """Bring the positionIndex entries for the children of parent up to date"""
+        count, tagCounts, stepMap = self.positionValid.get(parent, (0, {}, {}))
+        for pos in range(count, len(parent)):
+            ch = parent[pos]
+            ordinal = tagCounts.get(ch.tag, 0) + 1
+            tagCounts[ch.tag] = ordinal
+            step = '%s[%d]' % (ch.tag, ordinal)
+            self.positionIndex[ch] = (pos, step)
+            stepMap[step] = ch
+        self.positionValid[parent] = (len(parent), tagCounts, stepMap)
+
+    def _getPositionEntry(self, elt, parent):
+        """Return (position, xpath step) for an element with a known parent"""
+        entry = self.positionIndex.get(elt)
+        valid = self.positionValid.get(parent)
+        if entry is None or valid is None or entry[0] >= valid[0]:
+            with self.indexLock:
+                # Check again: another reader may have done it while we waited
+                entry = self.positionIndex.get(elt)
+                valid = self.positionValid.get(parent)
+                if entry is None or valid is None or entry[0] >= valid[0]:
+                    self._indexChildren(parent)
+                    entry = self.positionIndex[elt]
+        return entry
+
+    def _invalidatePositions(self, parent, pos, oldChildren):
+        """Forget positionIndex entries of the children of parent from pos onwards.
+        oldChildren are the elements that used to be at those indexed positions."""
+        count, tagCounts, stepMap = self.positionValid[parent]
+        for ch in oldChildren:
+            tagCounts[ch.tag] -= 1
+            step = self.positionIndex[ch][1]
+            if stepMap.get(step) is ch:
+                del stepMap[step]
+        self.positionValid[parent] = (pos, tagCounts, stepMap)
+
+    def _positionsAdded(self, elt, parent):
+        """Update positional index after elt has been inserted into parent"""
+        valid = self.positionValid.get(parent)
+        if valid is None:
+            return
+        count = valid[0]
+        if count == 0:
+            return
+        # If the last indexed child is still where it was the insert was after the indexed range
+        lastEntry = self.positionIndex.get(parent[count-1])
+        if lastEntry is not None and lastEntry[0] == count-1:
+            return
+        # Otherwise walk back over the shifted children to find the insert position
+        pos = count-1
+        while parent[pos] is not elt:
+            pos -= 1
+        self._invalidatePositions(parent, pos, parent[pos+1:count+1])
+
+    def _positionsDeleted(self, elt, parent):
+        """Update positional index after elt has been removed from parent"""
+        valid = self.positionValid.get(parent)
+        entry = self.positionIndex.get(elt)
+        if valid is None or entry is None or entry[0] >= valid[0]:
+            return
+        count = valid[0]
+        pos = entry[0]
+        self._invalidatePositions(parent, pos, [elt] + parent[pos:count-1])
 
-    @synchronized
+    @shared
+    def _getChildPosition(self, elt):
+        """Return index of elt in its parent"""
+        parent = self._getParent(elt)
+        assert parent is not None
+        return self._getPositionEntry(elt, parent)[0]
+
+    @shared
     def _getXPath(self, elt):
         if elt is None:
             return '$unconnectedElement'
+        steps = []
         parent = self._getParent(elt)
-        if parent is None:
-            return '/' + elt.tag
-        index = 0
-        for ch in parent:
-            if ch is elt:
-                break
-            if ch.tag == elt.tag:
-                index += 1
-        rv = self._getXPath(parent) + '/' + elt.tag
-        rv = rv + '[%d]' % (index+1)
-        return rv
+        while parent is not None:
+            steps.append(self._getPositionEntry(elt, parent)[1])
+            elt = parent
+            parent = self._getParent(elt)
+        steps.append('/' + elt.tag)
+        steps.reverse()
+        return '/'.join(steps)
+
+    def _structureChanged(self, elt):
+        """Called when the children of elt have been replaced without _elementAdded/_elementDeleted"""
+        self.positionValid.pop(elt, None)
+        self.structureGeneration += 1
+        self.contentVersion += 1
+        self._invalidateEventCaches(elt)
+
+    def _findPositional(self, absolute, steps):
+        """Resolve a compiled structural XPath through the positional index.
+        Returns list of matching elements, or None if the index cannot answer the query."""
+        elt = self.tree.getroot()
+        if absolute:
+            tag, ordinal = steps[0]
+            if tag != elt.tag or ordinal not in (None, 1):
+                return []
+            steps = steps[1:]
+        for tag, ordinal in steps:
+            valid = self.positionValid.get(elt)
+            if valid is None or valid[0] != len(elt):
+                with self.indexLock:
+                    valid = self.positionValid.get(elt)
+                    if valid is None or valid[0] != len(elt):
+                        self._indexChildren(elt)
+                        valid = self.positionValid[elt]
+            count, tagCounts, stepMap = valid
+            if ordinal is None:
+                # Unqualified step: only unambiguous if there is a single child with this tag
+                nMatches = tagCounts.get(tag, 0)
+                if nMatches > 1:
+                    return None
+                ordinal = 1
+            elt = stepMap.get('%s[%d]' % (tag, ordinal))
+            if elt is None:
+                return []
+        return [elt]
+
+    def _findByPath(self, path):
+        """Return list of elements matching path"""
+        compiled = _compilePath(path)
+        if compiled is not None:
+            positions = self._findPositional(*compiled)
+            if positions is not None:
+                return positions
+        with self.cacheLock:
+            if self.pathCacheGeneration != self.structureGeneration:
+                self.pathCache = {}
+                self.pathCacheGeneration = self.structureGeneration
+            positions = self.pathCache.get(path)
+        if positions is not None:
+            return positions
+        if path[:1] == '/':
+            positions = TREE.findAbsolute(self.documentElement, path, NAMESPACES)
+        else:
+            positions = self.tree.getroot().findall(path, NAMESPACES)
+        # Only results that cannot depend on attribute values can be remembered
+        if FIND_STRUCTURAL_PATH.match(path):
+            with self.cacheLock:
+                self.pathCache[path] = positions
+        return positions
 
-    @synchronized
+    @shared
     def _getElementByPath(self, path):
         if path == '/':
             # Findall implements bare / paths incorrectly
             positions = []
-        elif path[:1] == '/':
-            positions = self.documentElement.findall('.'+path, NAMESPACES)
         else:
-            positions = self.tree.getroot().findall(path, NAMESPACES)
+            positions = self._findByPath(path)
         if not positions:
             self.setError('No XML element matches XPath %s' % path)
             abort(404, 'No tree element matches XPath %s' % path)
@@ -632,6 +1420,16 @@ class Document(object):
     def _getElementByID(self, id):
         return self.idMap.get(id)
 
+    def _getCommandElement(self, command):
+        """Return the element a forwarded command applies to: the one with its xml:id if it has one,
+        otherwise the one at its (positional) path."""
+        id = command.get('id')
+        if id:
+            element = self.idMap.get(id)
+            if element is not None and element.get(NS_XML('id')) == id:
+                return element
+        return self._getElementByPath(command['path'])
+
 
 class DocumentXml(object):
     def __init__(self, document):
@@ -643,13 +1441,16 @@ class DocumentXml(object):
     def getLoggerExtra(self):
         return self.document.getLoggerExtra()
 
-    @synchronized
+    @edit
     def paste(self, path, where, tag=None, data='', mimetype='application/x-python-object'):
         self.logger.info('paste(%s,%s,%s,...)' % (path, where, tag), extra=self.getLoggerExtra())
         #
         # where should it go?
         #
         element = self.document._getElementByPath(path)
+        return self._paste(element, where, tag, data, mimetype)
+
+    def _paste(self, element, where, tag, data, mimetype):
         #
         # what should go there?
         #
@@ -669,25 +1470,28 @@ class DocumentXml(object):
             element.append(newElement)
             self.document._elementAdded(newElement, element)
         elif where == 'replace':
+            self.document._recordUndo(self.document._undoReplaced, element, dict(element.attrib), element.text, element.tail, list(element))
+            oldId = element.get(NS_XML('id'))
             element.clear()
+            self.document._structureChanged(element)
             for k, v in list(newElement.items()):
                 element.set(k, v)
             # xxxjack this may be unsafe, replacing children....
             for e in list(newElement):
                 element.append(e)
             newElement = element
-            self.document._elementChanged(element)
+            self.document._elementChanged(element, oldId=oldId)
         elif where == 'before':
             parent = self.document._getParent(element)
             assert parent is not None
-            pos = list(parent).index(element)
+            pos = self.document._getChildPosition(element)
             parent.insert(pos, newElement)
             self.document._elementAdded(newElement, parent)
         elif where == 'after':
             parent = self.document._getParent(element)
             assert parent is not None
-            pos = list(parent).index(element)
-            if pos == len(list(parent)):
+            pos = self.document._getChildPosition(element)
+            if pos == len(parent):
                 parent.append(newElement)
             else:
                 parent.insert(pos+1, newElement)
@@ -695,18 +1499,26 @@ class DocumentXml(object):
         else:
             self.document.setError('Internal error: unknown relative position %s' % where)
             abort(400, 'Unknown relative position %s' % where)
+        if where != 'replace':
+            self.document._recordUndo(self.document._undoAdded, newElement)
         return self.document._getXPath(newElement)
 
-    @synchronized
+    @edit
     def cut(self, path, mimetype='application/x-python-object'):
         self.logger.info('cut(%s)' % (path), extra=self.getLoggerExtra())
         element = self.document._getElementByPath(path)
+        return self._cut(element, mimetype)
+
+    def _cut(self, element, mimetype):
         parent = self.document._getParent(element)
-        parent.remove(element)
-        self.document._elementDeleted(element)
+        if self.document.undoLog is not None:
+            pos = self.document._getChildPosition(element)
+            subtree = [(e, list(e)) for e in element.iter()]
+            self.document._recordUndo(self.document._undoDeleted, element, parent, pos, subtree)
+        self.document._removeElement(element, parent)
         return self.document._fromET(element, mimetype)
 
-    @synchronized
+    @shared
     def get(self, path, mimetype='application/x-python-object'):
         self.logger.info('get(%s)' % (path), extra=self.getLoggerExtra())
         element = self.document._getElementByPath(path)
@@ -716,6 +1528,9 @@ class DocumentXml(object):
     def modifyAttributes(self, path, attrs, mimetype='application/x-python-object'):
         self.logger.info('modifyAttributes(%s, ...)' % (path), extra=self.getLoggerExtra())
         element = self.document._getElementByPath(path)
+        return self._modifyAttributes(element, attrs, mimetype)
+
+    def _modifyAttributes(self, element, attrs, mimetype):
         if mimetype == 'application/x-python-object':
             pass
         elif mimetype == 'application/json':
@@ -724,27 +1539,34 @@ class DocumentXml(object):
             self.document.setError('Internal error: unexpected mimetype %s' % mimetype)
             abort(400, 'Unexpected mimetype %s' % mimetype)
         assert isinstance(attrs, dict)
+        self.document._recordUndo(self.document._undoChanged, element, dict(element.attrib))
         existingAttrs = element.attrib
+        oldId = existingAttrs.get(NS_XML('id'))
+        changed = {}
         for k, v in list(attrs.items()):
             if v is None:
                 if k in existingAttrs:
                     existingAttrs.pop(k)
-            else:
+                    changed[k] = None
+            elif existingAttrs.get(k) != v:
                 existingAttrs[k] = v
+                changed[k] = v
         rv = self.document._getXPath(element)
-        self.document._elementChanged(element)
+        self.document._elementChanged(element, changed, oldId)
         return rv
 
-    @synchronized
+    @edit
     def modifyData(self, path, data):
         self.logger.info('modifyData(%s, ...)' % (path), extra=self.getLoggerExtra())
         element = self.document._getElementByPath(path)
+        self.document._recordUndo(self.document._undoDataChanged, element, element.text, element.tail)
         if data is None:
             element.text = None
             element.tail = None
         else:
             element.text = data
             element.tail = None
+        self.document._dataChanged(element)
         return self.document._getXPath(element)
 
     @edit
@@ -767,31 +1589,147 @@ class DocumentXml(object):
         # newElement._setroot(None)
         return self.paste(path, where, None, sourceElement)
 
+    def batch(self, operations):
+        """Apply a list of operations as a single edit. Each operation is a dict with a verb (one of
+        BATCH_VERBS) and the arguments for that method. Either all operations are applied and forwarded
+        as one set of changes, or none are. Returns the list of results."""
+        self.logger.info('batch(%d operations)' % len(operations), extra=self.getLoggerExtra())
+        return self.document._batch(self, BATCH_VERBS, operations, 'operation')
+
+
+class EventTemplate(object):
+    """A triggerable event, compiled for trigger and enqueue: for each parameter, which attributes of which
+    elements of a copy of the event should be set. Elements are found by child index, not by XPath."""
+
+    def __init__(self, events, element):
+        self.events = events
+        self.document = events.document
+        self.element = element
+        self.slots = {}  # Attribute XPath -> (path, child index path, attribute name)
+        self.destinations = {}  # tt:parameter element in the event -> [(path, child index path, attribute name, value), ...]
+
+    def _indexPath(self, path):
+        """Return the child indices leading from the event to the element path refers to, or None if there is none"""
+        target = self.element.find(path, NAMESPACES)
+        if target is None:
+            return None
+        rv = []
+        while target is not self.element:
+            rv.append(self.document._getChildPosition(target))
+            target = self.document._getParent(target)
+        rv.reverse()
+        return tuple(rv)
+
+    def _isInside(self, elt):
+        while elt is not None:
+            if elt is self.element:
+                return True
+            elt = self.document._getParent(elt)
+        return False
+
+    def getDestinations(self, parameter):
+        """For a parameter/value coming from the front end, returns what to set where, like
+        DocumentEvents._getParameterDestinations, as (path, child index path, attribute, value) tuples"""
+        try:
+            parPath = parameter['parameter']
+            parValue = parameter['value']
+        except KeyError:
+            self.events._documentError('Missing parameter and/or value in event')
+        if '@' in parPath:
+            slot = self.slots.get(parPath)
+            if slot is None:
+                path, attr = self.events._splitXPath(parPath)
+                slot = (path, self._indexPath(path), attr)
+                with self.events.cacheLock:
+                    slot = self.slots.setdefault(parPath, slot)
+            return [slot + (parValue,)]
+        elt = self.document._getElementByPath(parPath)
+        if elt is None:
+            self.events._documentError('XPath in parameter does not refer to existing element')
+        rv = self.destinations.get(elt)
+        if rv is None:
+            rv = []
+            for dElt in elt.findall('./tt:destination', NAMESPACES):
+                dPath, dAttr = self.events._splitXPath(dElt.get(NS_TRIGGER("parameter")))
+                rv.append((dPath, self._indexPath(dPath), dAttr, dElt.get(NS_TRIGGER("value"))))
+            # Only parameters of this event are invalidated with it
+            if self._isInside(elt):
+                with self.events.cacheLock:
+                    rv = self.destinations.setdefault(elt, rv)
+        return rv
+
+    def setParameters(self, newElement, parameters, newParent):
+        """Fill in the parameters in newElement, a copy of the event that will be inserted into newParent"""
+        for par in parameters:
+            parValue = par['value']
+            for path, indexPath, attr, value in self.getDestinations(par):
+                if indexPath is None:
+                    self.events._documentError("No element matches XPath %s" % path)
+                e = newElement
+                for index in indexPath:
+                    e = e[index]
+                e.set(attr, self.events._minimalAVT(value, parValue, newElement, newParent))
+
+
 class DocumentEvents(object):
     def __init__(self, document):
         self.document = document
         self.tree = document.tree
         self.lock = self.document.lock
+        self.cacheLock = self.document.cacheLock
         self.logger = self.document.logger.getChild('events')
+        # Cached descriptions: event element -> {(trigger, state): (description, structureGeneration)}. The generation
+        # is None unless the description contains XPaths of elements, which change when the structure changes.
+        self.descriptionCache = {}
+        # Option list element -> event elements whose cached descriptions contain its options
+        self.optionListUsers = {}
+        # Version number of the events list, incremented whenever the result of get changes
+        self.versionLock = threading.Lock()
+        self.version = 0
+        self.versionEvents = None  # Result of get for the current version
+        self.versionHistory = collections.deque(maxlen=EVENTS_HISTORY)  # (version, result of get), oldest first
+        # Values of XPath variables in attribute value templates, valid until the document changes
+        self.avtValues = {}
+        # Event element -> EventTemplate, valid until something in the event changes
+        self.templates = {}
 
     def getLoggerExtra(self):
         return self.document.getLoggerExtra()
 
+    def _invalidateCaches(self, elt, stateOnly=False):
+        """Drop the cached descriptions of the events that contain elt or use it as option list, and the cached
+        values of XPath variables (all if elt is None). If stateOnly only the tls: attributes of elt have changed,
+        which only matters for XPath variables that refer to them. Called with the document lock held exclusively."""
+        if elt is None:
+            self.descriptionCache = {}
+            self.optionListUsers = {}
+            self.avtValues = {}
+            self.templates = {}
+            return
+        if not stateOnly:
+            self.avtValues = {}
+        elif self.avtValues:
+            self.avtValues = dict((expr, v) for expr, v in self.avtValues.items() if not 'tls:' in expr)
+        parentMap = self.document.parentMap
+        while elt is not None:
+            self.descriptionCache.pop(elt, None)
+            self.templates.pop(elt, None)
+            for user in self.optionListUsers.pop(elt, ()):
+                self.descriptionCache.pop(user, None)
+            elt = parentMap.get(elt)
+
     def _documentError(self, message):
         """Error in document. Report to trigger tool user as well as to the log"""
         self.document.setError(message)
         self.logger.error(message, extra=self.getLoggerExtra())
         abort(400, message)
 
-    @synchronized
+    @shared
     def get(self, caller='get'):
         """REST get command: returns list of triggerable and modifiable events to the front end UI"""
-        exprTriggerable = './/tt:events/*[@tt:name]'
-        exprComplete = './/tt:completeEvents/*[@tt:name]'
-        exprModifyable = './/tl:par/*[@tt:name][@tls:state]'
-        elementsTriggerable = self.tree.getroot().findall(exprTriggerable, NAMESPACES)
-        elementsComplete = self.tree.getroot().findall(exprComplete, NAMESPACES)
-        elementsModifyable = self.tree.getroot().findall(exprModifyable, NAMESPACES)
+        elementsTriggerable = self.document._getEventElements(NS_TRIGGER('events'))
+        elementsComplete = self.document._getEventElements(NS_TRIGGER('completeEvents'))
+        elementsModifyable = self.document._getActiveElements()
         eventList = []
         for elt in elementsTriggerable:
             eventList.append(self._getDescription(elt, trigger=True, state='abstract'))
@@ -810,9 +1748,57 @@ class DocumentEvents(object):
         }
         return rv
 
-    @synchronized
+    @shared
+    def getVersioned(self):
+        """Return the current version number of the events list and the list itself (as returned by get)"""
+        rv = self.get(caller='getVersioned')
+        with self.versionLock:
+            if rv != self.versionEvents:
+                self.version += 1
+                self.versionEvents = rv
+                self.versionHistory.append((self.version, rv))
+            return self.version, self.versionEvents
+
+    @shared
+    def getSince(self, since):
+        """Return the changes to the events list since version since, in the same form as they are broadcast.
+        If that version is no longer available returns the complete list with its version, marked resyncRequired."""
+        version, events = self.getVersioned()
+        old = None
+        with self.versionLock:
+            for v, e in self.versionHistory:
+                if v == since:
+                    old = e
+                    break
+        if old is None:
+            self.logger.info('getSince: version %d no longer available, resync required' % since, extra=self.getLoggerExtra())
+            return dict(events, version=version, resyncRequired=True)
+        rv = _eventsDelta(old, events)
+        rv['version'] = version
+        rv['previous'] = since
+        return rv
+
+    @shared
     def _getDescription(self, elt, trigger, state=None):
-        """Returns description of a triggerable or modifiable event for the front end"""
+        """Returns description of a triggerable or modifiable event for the front end. The description may
+        come from the cache, so it must not be modified."""
+        cached = self.descriptionCache.get(elt, {}).get((trigger, state))
+        if cached is not None:
+            rv, generation = cached
+            if generation is None or generation == self.document.structureGeneration:
+                return rv
+        dependencies = dict(cacheable=True, positional=False, optionLists=[])
+        rv = self._buildDescription(elt, trigger, state, dependencies)
+        if dependencies['cacheable']:
+            generation = self.document.structureGeneration if dependencies['positional'] else None
+            with self.cacheLock:
+                self.descriptionCache.setdefault(elt, {})[(trigger, state)] = (rv, generation)
+                for optionListElt in dependencies['optionLists']:
+                    self.optionListUsers.setdefault(optionListElt, set()).add(elt)
+        return rv
+
+    def _buildDescription(self, elt, trigger, state, dependencies):
+        """Build the description of an event. Records in dependencies what, outside the event, it depends on."""
         # xxxjack should move to ElementDelegate
         if state == 'abstract':
             parameterExpr = './tt:parameters/tt:parameter'
@@ -844,12 +1830,15 @@ class DocumentEvents(object):
                 # and trigger/modify will handle it.
                 #
                 pData['parameter'] = self.document._getXPath(paramElt)
+                dependencies['positional'] = True
             if NS_TRIGGER('type') in paramElt.attrib:
                 pData['type'] = paramElt.get(NS_TRIGGER('type'))
             if NS_TRIGGER('value') in paramElt.attrib:
                 value = paramElt.get(NS_TRIGGER('value'))
                 if pData['type'] == 'string' and '{' in value:
+                    # Computed values (clocks, document variables) can change at any time
                     value = self._minimalAVT(value, "", paramElt)
+                    dependencies['cacheable'] = False
                 pData['value'] = value
             if NS_TRIGGER('required') in paramElt.attrib:
                 required = paramElt.get(NS_TRIGGER('required'))
@@ -865,6 +1854,7 @@ class DocumentEvents(object):
                 if optionListElt is None:
                     self._documentError('tt:parameter optionListId does not exist: %s' % optionListId)
                 optionValues = self._getOptions(optionListElt)
+                dependencies['optionLists'].append(optionListElt)
                 # self.logger.debug('_getDescription: got %d selection options from element %s' % (len(optionValues), optionListId), extra=self.getLoggerExtra())
             else:
                 optionValues = self._getOptions(paramElt)
@@ -874,6 +1864,7 @@ class DocumentEvents(object):
             if pData.get('type') == 'selection' and not pData.get('options'):
                 self.logger.warn('tt:parameter with type=selection but no options to select', extra=self.getLoggerExtra())
                 self.document.setError('tt:parameter with type=selection but no options to select')
+                dependencies['cacheable'] = False  # So the error is reported again
 
             #
             # Append all data on this parameter to the list of all parameters
@@ -907,7 +1898,7 @@ class DocumentEvents(object):
 
         return rv
 
-    @synchronized
+    @shared
     def _getOptions(self, optionListElt):
         optionElements = optionListElt.findall('./au:item', NAMESPACES)
         optionValues = []
@@ -921,7 +1912,7 @@ class DocumentEvents(object):
             })
         return optionValues
 
-    @synchronized
+    @shared
     def _getParameterDestinations(self, parameter):
         """For a parameter/value coming from the front end, returns what to set where"""
         # xxxjack should move to ElementDelegate
@@ -964,41 +1955,51 @@ class DocumentEvents(object):
 
         return path, attr
 
-    @synchronized
+    @shared
     def _minimalAVT(self, value, userValue, contextElement, parentElement=None):
-        """Handle computed values"""
-        match = INTERPOLATION.search(value)
-        if not match:
+        """Handle computed values: replace every {...} expression in value"""
+        tokens = _compileAVT(value)
+        if tokens is None:
             return value
-        expr = value[match.start()+1:match.end()-1]
-        if expr == "tt:clock(.)":
-            exprValue = self._getClock(contextElement)
-        elif expr == "tt:clock(..)":
-            if parentElement is None:
-                parentElement = self.document._getParent(contextElement)
-            exprValue = self._getClock(parentElement)
-        elif expr == "tt:value()":
-            exprValue = userValue
-        else:
-            # Presume it is an XPath expression leading to a variable in the document.
-            matchedElements = self.tree.getroot().findall(expr, NAMESPACES)
-            if matchedElements:
-                v = ''
-                for e in matchedElements:
-                    if e.text:
-                        v += e.text.strip()
-                    if e.tail:
-                        v += e.tail.strip()
-                exprValue = v
+        rv = []
+        for kind, text in tokens:
+            if kind == 'literal':
+                rv.append(text)
+            elif kind == 'clock':
+                if text == '.':
+                    rv.append(self._getClock(contextElement))
+                else:
+                    if parentElement is None:
+                        parentElement = self.document._getParent(contextElement)
+                    rv.append(self._getClock(parentElement))
+            elif kind == 'value':
+                rv.append(str23compat(userValue))
             else:
-                self.logger.error("Unexpected AVT: %s" % value, extra=self.getLoggerExtra())
-                exprValue = "{" + expr + "}"
-
-        exprValue = str23compat(exprValue)
-        value = value[:match.start()] + exprValue + value[match.end():]
-        return value
+                rv.append(self._getVariable(text, value))
+        return ''.join(rv)
+
+    @shared
+    def _getVariable(self, expr, value):
+        """Return the text of the elements an XPath expression in attribute value template value refers to"""
+        rv = self.avtValues.get(expr)
+        if rv is not None:
+            return rv
+        matchedElements = self.document.tree.getroot().findall(expr, NAMESPACES)
+        if not matchedElements:
+            self.logger.error("Unexpected AVT: %s" % value, extra=self.getLoggerExtra())
+            return "{" + expr + "}"
+        rv = ''
+        for e in matchedElements:
+            if e.text:
+                rv += e.text.strip()
+            if e.tail:
+                rv += e.tail.strip()
+        rv = str23compat(rv)
+        with self.cacheLock:
+            self.avtValues[expr] = rv
+        return rv
 
-    @synchronized
+    @shared
     def _getClock(self, element):
         """Return current clock value for an element"""
 
@@ -1011,6 +2012,14 @@ class DocumentEvents(object):
         # self.document.setError("Clock for %s used, but it is not running."%self.document._getXPath(element))
         return "0"
 
+    def _getTemplate(self, element):
+        """Return the EventTemplate for an event element (compiling it if needed)"""
+        template = self.templates.get(element)
+        if template is None:
+            with self.cacheLock:
+                template = self.templates.setdefault(element, EventTemplate(self, element))
+        return template
+
     @edit
     def trigger(self, id, parameters):
         """REST trigger command: triggers an event"""
@@ -1035,25 +2044,14 @@ class DocumentEvents(object):
         newElement = copy.deepcopy(element)
         newElement.set(NS_TRIGGER("wantstatus"), "true")
         self.document._afterCopy(newElement, triggerAttributes=True)
-
-        for par in parameters:
-            parValue = par['value']
-            for path, attr, value in self._getParameterDestinations(par):
-                e = newElement.find(path, NAMESPACES)
-
-                value = self._minimalAVT(value, parValue, newElement, newParent)
-
-                if e is None:
-                    self._documentError("No element matches XPath %s" % path)
-
-                e.set(attr, value)
+        self._getTemplate(element).setParameters(newElement, parameters, newParent)
 
         newParent.append(newElement)
         self.document._elementAdded(newElement, newParent)
+        self.document._recordUndo(self.document._undoAdded, newElement)
 
-        self.document.companionTimelineIsActive = False
-        self.document.clearError()
-        self.document.asynch().requestBroadcastToFrontends()
+        self._actionSucceeded()
+        self._requestBroadcast()
         return newElement.get(NS_XML('id'))
 
     @edit
@@ -1094,24 +2092,14 @@ class DocumentEvents(object):
             newElement.set(NS_TRIGGER("productionIdTransient"), "true")
             newElement.set(NS_TRIGGER("productionParent"), id)
 
-        for par in parameters:
-            parValue = par['value']
-            for path, attr, value in self._getParameterDestinations(par):
-                e = newElement.find(path, NAMESPACES)
-
-                value = self._minimalAVT(value, parValue, newElement, newParent)
-
-                if e is None:
-                    self._documentError("No element matches XPath %s" % path)
-
-                e.set(attr, value)
+        self._getTemplate(element).setParameters(newElement, parameters, newParent)
 
         newParent.append(newElement)
         self.document._elementAdded(newElement, newParent)
+        self.document._recordUndo(self.document._undoAdded, newElement)
 
-        self.document.companionTimelineIsActive = False
-        self.document.clearError()
-        self.document.asynch().requestBroadcastToFrontends()
+        self._actionSucceeded()
+        self._requestBroadcast()
         return newElement.get(NS_XML('id'))
 
     @edit
@@ -1126,10 +2114,21 @@ class DocumentEvents(object):
         oldName = element.attrib.pop(NS_TRIGGER("name"), None)
         if oldName:
             element.attrib[NS_TRIGGER("oldName")] = oldName
+            self.document._nameRemoved(oldName)
+            self.document.contentVersion += 1
+            self.document._invalidateEventCaches(element)
+            self.document._recordUndo(self._undoDequeue, element, oldName)
 
-        self.document.asynch().requestBroadcastToFrontends()
+        self._requestBroadcast()
         return True
 
+    def _undoDequeue(self, element, oldName):
+        del element.attrib[NS_TRIGGER("oldName")]
+        element.set(NS_TRIGGER("name"), oldName)
+        self.document._nameAdded(oldName)
+        self.document.contentVersion += 1
+        self.document._invalidateEventCaches(element)
+
     @edit
     def modify(self, id, parameters):
         """REST modify command: modifies a running event"""
@@ -1141,7 +2140,8 @@ class DocumentEvents(object):
             self.document.setError("No such xml:id: %s" % id)
             abort(404, 'No such xml:id: %s' % id)
 
-        allElements = set()
+        changes = {}
+        oldIds = {}
 
         for par in parameters:
             parValue = par['value']
@@ -1153,26 +2153,52 @@ class DocumentEvents(object):
                 if e is None:
                     self._documentError('No element matches XPath %s' % path)
 
+                if not e in changes:
+                    self.document._recordUndo(self.document._undoChanged, e, dict(e.attrib))
+                    oldIds[e] = e.get(NS_XML('id'))
                 e.set(attr, value)
-                allElements.add(e)
+                changes.setdefault(e, {})[attr] = value
 
-        for e in allElements:
-            self.document._elementChanged(e)
+        for e, changed in changes.items():
+            self.document._elementChanged(e, changed, oldIds[e])
 
-        self.document.companionTimelineIsActive = False
-        self.document.clearError()
+        self._actionSucceeded()
 
         return ""
 
+    def batch(self, actions):
+        """Apply a list of actions as a single edit. Each action is a dict with a verb (one of EVENT_BATCH_VERBS)
+        and the arguments for that method. Either all actions are applied, forwarded as one set of changes
+        and broadcast once, or none are. Returns the list of results (the new xml:id for trigger and enqueue)."""
+        self.logger.info('batch(%d actions)' % len(actions), extra=self.getLoggerExtra())
+        return self.document._batch(self, EVENT_BATCH_VERBS, actions, 'action')
+
+    def _requestBroadcast(self):
+        """Broadcast the events list to the frontends, or when the current transaction is committed"""
+        self.document._afterCommit(self.document.asynch().requestBroadcastToFrontends)
+
+    def _actionSucceeded(self):
+        """Clear the error state after a successful action, or when the current transaction is committed
+        (so a batch that is rolled back leaves it alone)"""
+        self.document._afterCommit(self._clearErrorState)
+
+    def _clearErrorState(self):
+        self.document.companionTimelineIsActive = False
+        self.document.clearError()
+
     def _productionIdFinished(self, productionId):
         """Called when a transient productionId has finished running. Remove from completeEvents"""
-        events = self.tree.getroot().findall(".//tt:completeEvents/*[@tt:name][@tt:productionId='%s']" % productionId, NAMESPACES)
+        events = self.document._getEventElements(NS_TRIGGER('completeEvents'))
+        events = [elt for elt in events if elt.get(NS_TRIGGER('productionId')) == productionId]
         self.logger.info("productionIdFinished(%s): removing %d events" % (productionId, len(events)))
         for elt in events[:1]:
             # Removing the tt:name attribute will make the event invisible to events().get()
             oldName = elt.attrib.pop(NS_TRIGGER("name"), None)
             if oldName:
                 elt.attrib[NS_TRIGGER("oldName")] = oldName
+                self.document._nameRemoved(oldName)
+                self.document.contentVersion += 1
+                self.document._invalidateEventCaches(elt)
 
 class DocumentRemote(object):
     def __init__(self, document):
@@ -1185,12 +2211,12 @@ class DocumentRemote(object):
     def getLoggerExtra(self):
         return self.document.getLoggerExtra()
 
-    @synchronized
+    @shared
     def _getClockState(self):
         if self.statusElement is None:
-            eventParents = self.tree.getroot().findall('.//tt:events/..', NAMESPACES)
-            if eventParents:
-                self.statusElement = eventParents[0]
+            eventContainers = self.document._getEventContainers(NS_TRIGGER('events'))
+            if eventContainers:
+                self.statusElement = self.document._getParent(eventContainers[0])
             else:
                 # If there are no events in the document we use the first child of the root.
                 self.statusElement = list(self.tree.getroot())[0]
@@ -1203,12 +2229,12 @@ class DocumentRemote(object):
         playing = not not (clockRunning and clockRunning != "false")
         return curClock, playing
 
-    @synchronized
+    @shared
     def get(self):
         if self.statusElement is None:
-            eventParents = self.tree.getroot().findall('.//tt:events/..', NAMESPACES)
-            if eventParents:
-                self.statusElement = eventParents[0]
+            eventContainers = self.document._getEventContainers(NS_TRIGGER('events'))
+            if eventContainers:
+                self.statusElement = self.document._getParent(eventContainers[0])
             else:
                 # If there are no events in the document we use the first child of the root.
                 self.statusElement = list(self.tree.getroot())[0]
@@ -1267,10 +2293,16 @@ class DocumentServe(object):
         self.lock = self.document.lock
         self.allContextIDs = []
         self.contextID = None
-        self.callbacks = set()
+        self.callbacks = delivery.DeliveryPool(onEvict=self._callbackEvicted)
         self.lastClientServed = None
-        self.operationHistory = []
+        self.operationHistory = history.OperationHistory(GlobalSettings.historyWindow)
+        self.checkpoints = collections.deque()  # (generation, serialized document) for catchup, oldest first
         self.previewPlayerClockEpoch = None
+        # Serialized timeline document per flavour (preview or viewer): (document contentVersion, data)
+        self.timelineCache = {}
+        # Serializations in progress per flavour: (document contentVersion, threading.Event set when done)
+        self.timelineInProgress = {}
+        self.timelineLock = threading.Lock()  # Protects timelineCache and timelineInProgress
         self.logger = self.document.logger.getChild('serve')
 
     def getLoggerExtra(self):
@@ -1279,20 +2311,56 @@ class DocumentServe(object):
     @synchronized
     def _nextGeneration(self, sameValue):
         rootElt = self.tree.getroot()
-        gen = int(rootElt.get(NS_AUTH("generation"), 0))
+        oldGen = rootElt.get(NS_AUTH("generation"))
+        gen = int(oldGen or 0)
         if not sameValue:
             gen += 1
-        rootElt.set(NS_AUTH("generation"), str23compat(gen))
+        if str23compat(gen) != oldGen:
+            rootElt.set(NS_AUTH("generation"), str23compat(gen))
+            self.document.contentVersion += 1
         return gen
 
-    @synchronized
+    @shared
     def get_timeline(self, viewer=False):
         """Get timeline document contents (xml) for this authoring document.
-        At the moment, this is actually the whole authoring document itself."""
+        At the moment, this is actually the whole authoring document itself.
+        The serialized document is cached until the document changes. Readers hold the document lock
+        shared, so concurrent requests for a version that is being serialized wait for that serialization
+        instead of doing their own."""
         self.logger.info('serving timeline.xml document', extra=self.getLoggerExtra())
-        return ET.tostring(self.tree.getroot(), encoding=XML_ENCODING)
-
-    @synchronized
+        version = self.document.contentVersion
+        with self.timelineLock:
+            cached = self.timelineCache.get(viewer)
+            if cached and cached[0] == version:
+                return cached[1]
+            inProgress = self.timelineInProgress.get(viewer)
+            if inProgress and inProgress[0] == version:
+                done = inProgress[1]
+                serialize = False
+            else:
+                done = threading.Event()
+                self.timelineInProgress[viewer] = (version, done)
+                serialize = True
+        if not serialize:
+            done.wait()
+            with self.timelineLock:
+                cached = self.timelineCache.get(viewer)
+            if cached and cached[0] == version:
+                return cached[1]
+            # The other serialization failed, so try it ourselves
+            return TREE.tostring(self.tree.getroot())
+        try:
+            data = TREE.tostring(self.tree.getroot())
+            with self.timelineLock:
+                self.timelineCache[viewer] = (version, data)
+        finally:
+            with self.timelineLock:
+                if self.timelineInProgress.get(viewer) == (version, done):
+                    del self.timelineInProgress[viewer]
+            done.set()
+        return data
+
+    @shared
     def get_layout(self, viewer=False):
         """Get the layout document contents (json) for this authoring document.
         At the moment, the layout document JSON representation is stored in a toplevel
@@ -1460,7 +2528,7 @@ class DocumentServe(object):
         self.document.asynch().requestBroadcastToFrontends()
         return rv
 
-    @synchronized
+    @edit
     def _setDocumentState(self, documentState):
         clockEpoch = documentState.get("clockEpoch")
         if clockEpoch:
@@ -1484,6 +2552,7 @@ class DocumentServe(object):
                         self.logger.debug('_setDocumentState: element finished: %s, productionId %s' % (eltId, productionId))
                         if productionId:
                             self.document.events()._productionIdFinished(productionId)
+        self.document._clockChanged()
         self.document.asynch().requestBroadcastToFrontends()
 
     def _elementStateChanged(self, elt, eltState):
@@ -1535,6 +2604,7 @@ class DocumentServe(object):
                 elt.attrib.pop(NS_TIMELINE_INTERNAL("clockRunning"))
             if newEpoch:
                 self.document.clock.stop()
+        self.document._elementStateChanged(elt)
 
         return True
 
@@ -1543,62 +2613,96 @@ class DocumentServe(object):
             self.logger.info('forward %d operations to %d callbacks' % (len(operations), len(self.callbacks)), extra=self.getLoggerExtra())
         else:
             self.logger.debug('forward %d operations to %d callbacks' % (len(operations), len(self.callbacks)), extra=self.getLoggerExtra())
-        gen = self._nextGeneration(not operations)
-        if operations:
-            self._memorizeOperations(gen, operations)
+        with self.lock:
+            gen = self._nextGeneration(not operations)
+            if operations:
+                self._memorizeOperations(gen, operations)
+                if not self.checkpoints or gen - self.checkpoints[-1][0] >= GlobalSettings.checkpointInterval:
+                    self._checkpoint(gen)
         #
         # Forward to websocket listeners first
         #
         self.document.asynch().forwardDocumentModifications(dict(generation=gen, operations=operations))
         #
-        # Now forward to REST listeners (code to be removed soon)
+        # Now forward to REST listeners (code to be removed soon). This only queues the requests, they are
+        # delivered by worker threads so a slow timeline service does not delay the edit.
         #
-        toRemove = []
-        wantStateUpdates = True
-        for callback in self.callbacks:
-            try:
-                requestStartTime = time.time()  # Debugging: sometimes requests take a very long time
-                args = dict(generation=gen, operations=operations)
-                # for the first successful one, add updateState=True
-                if wantStateUpdates:
-                    args['wantStateUpdates'] = True
-                r = requests.put(callback, json=args)
-                r.raise_for_status()
-                wantStateUpdates = False
-            except requests.exceptions.RequestException:
-                self.logger.warning("forward: PUT failed for %s" % callback, extra=self.getLoggerExtra())
-                self.document.setError("Error communicating to timeline service")
-                toRemove.append(callback)
-            else:
-                requestDuration = time.time() - requestStartTime
-                if requestDuration > 2:
-                    self.logger.warning("forward: PUT took %d seconds for %s" % (requestDuration, callback), extra=self.getLoggerExtra())
-
-            # Only continue if we have anything to say...
-            if not operations and not wantStateUpdates:
+        for i, callback in enumerate(self.callbacks.urls()):
+            args = dict(generation=gen, operations=operations)
+            if i == 0:
+                # The first callback also sends us state updates
+                args['wantStateUpdates'] = True
+            elif not operations:
+                # Only continue if we have anything to say...
                 break
+            self.callbacks.put(callback, args)
 
-        for callback in toRemove:
-            self.logger.info('removeCallback(%s)' % callback, extra=self.getLoggerExtra())
-            self.callbacks.discard(callback)
+    def _callbackEvicted(self, callback, reason):
+        self.logger.warning("forward: removed callback %s: %s" % (callback, reason), extra=self.getLoggerExtra())
+        self.document.setError("Error communicating to timeline service")
 
     @synchronized
     def _memorizeOperations(self, gen, operations):
         """Remember old operations, solater clients can refresh in case they missed some between getting the document and
         starting to listen to the broadcasts."""
-        assert len(self.operationHistory) <= gen
-        while len(self.operationHistory) < gen:
-            self.operationHistory.append((len(self.operationHistory), []))
-        self.operationHistory.append((gen, operations))
+        self.operationHistory.append(gen, operations)
 
-    @synchronized
+    @shared
     def gethistory(self, oldest=None, viewer=False):
+        """Return the (generation, operations) list from generation oldest onwards, for the generations that
+        have operations plus the current one. If those generations are no longer available returns a dict
+        telling the client to reload the document."""
         if not oldest:
             oldest = 0
         oldest = int(oldest)
-        rv = self.operationHistory[oldest:]
+        rv = self.operationHistory.get(oldest)
+        if rv is None:
+            self.logger.info('gethistory: generation %d no longer available, resync required' % oldest, extra=self.getLoggerExtra())
+            return dict(resyncRequired=True, oldest=self.operationHistory.oldest(), generation=self.operationHistory.generation)
         return rv
 
+    @synchronized
+    def _checkpoint(self, gen):
+        """Remember the serialized document at generation gen, if it is exactly that (i.e. there are no edits
+        waiting to be forwarded), and forget the checkpoints that are too old to catch up from or that
+        are more than maxCheckpoints."""
+        if self.document.unforwardedEdits:
+            return
+        self.checkpoints.append((gen, self.get_timeline()))
+        oldest = self.operationHistory.oldest()
+        while len(self.checkpoints) > 1 and self.checkpoints[0][0] < oldest:
+            self.checkpoints.popleft()
+        while len(self.checkpoints) > max(1, GlobalSettings.maxCheckpoints):
+            self.checkpoints.popleft()
+
+    @synchronized
+    def catchup(self, generation=None, viewer=False):
+        """Return the newest checkpoint at or before generation (default: the current one) plus the
+        operations after it, as a dict with the generation and document of the checkpoint and the list of
+        (generation, operations) after it. If that is not possible returns a dict telling the client to
+        reload the document."""
+        current = int(self.tree.getroot().get(NS_AUTH("generation")) or 0)
+        if generation is None:
+            generation = current
+        generation = int(generation)
+        checkpoint = None
+        for cp in reversed(self.checkpoints):
+            if cp[0] <= generation:
+                checkpoint = cp
+                break
+        if checkpoint is None and generation >= current:
+            self._checkpoint(current)
+            if self.checkpoints:
+                checkpoint = self.checkpoints[-1]
+        operations = None
+        if checkpoint is not None:
+            operations = self.operationHistory.get(checkpoint[0] + 1)
+        if operations is None:
+            self.logger.info('catchup: no checkpoint for generation %d, resync required' % generation, extra=self.getLoggerExtra())
+            return dict(resyncRequired=True, oldest=self.operationHistory.oldest(), generation=current)
+        self.logger.info('catchup: checkpoint %d plus %d generations' % (checkpoint[0], len(operations)), extra=self.getLoggerExtra())
+        return dict(generation=checkpoint[0], document=checkpoint[1], operations=operations)
+
 
 class DocumentSettings(object):
     def __init__(self, document):
@@ -1679,6 +2783,14 @@ class DocumentAsync(threading.Thread):
         self.socketOut = None
         self.channelIn = None
         self.channelOut = None
+        # Broadcasts of the events list are coalesced: at most one per GlobalSettings.broadcastInterval
+        self.broadcastLock = threading.Lock()
+        self.broadcastPending = False  # A broadcast has been requested but not done yet
+        self.broadcastTimer = None
+        self.lastBroadcastTime = 0
+        self.lastBroadcastVersion = 0  # Version of the events list that was broadcast last
+        self.lastBroadcastEvents = None  # and the list itself, to compute the changes for the next broadcast
+        self.emitLock = threading.Lock()  # Keeps broadcasts from different threads in order
         if self.document.testMode:
             return
         websocket_service = GlobalSettings.websocketInternalService
@@ -1720,6 +2832,10 @@ class DocumentAsync(threading.Thread):
 
     def stop(self):
         self.running = False
+        with self.broadcastLock:
+            if self.broadcastTimer is not None:
+                self.broadcastTimer.cancel()
+                self.broadcastTimer = None
 
     def run(self):
         self.logger.debug('DocumentAsync listener started')
@@ -1732,18 +2848,50 @@ class DocumentAsync(threading.Thread):
                 traceback.print_exc()
         self.logger.debug('DocumentAsync listener stopped')
 
-    @synchronized
     def requestBroadcastToFrontends(self):
+        """Broadcast the events list soon. The first request after a quiet period is broadcast immediately,
+        further requests within broadcastInterval are combined into a single broadcast at the end of it."""
+        with self.broadcastLock:
+            self.broadcastPending = True
+            if self.broadcastTimer is not None:
+                return
+            delay = self.lastBroadcastTime + GlobalSettings.broadcastInterval - time.time()
+            if delay > 0:
+                self.broadcastTimer = threading.Timer(delay, self._broadcastTimerExpired)
+                self.broadcastTimer.daemon = True
+                self.broadcastTimer.start()
+                return
+            self.broadcastPending = False
+            self.lastBroadcastTime = time.time()
         self.broadcastEventsToFrontends()
 
-    @synchronized
+    def _broadcastTimerExpired(self):
+        with self.broadcastLock:
+            self.broadcastTimer = None
+            if not self.broadcastPending:
+                return
+            self.broadcastPending = False
+            self.lastBroadcastTime = time.time()
+        self.broadcastEventsToFrontends()
+
+    @shared
     def broadcastEventsToFrontends(self):
-        events = self.document.events().get(caller='broadcast')
+        """Broadcast the changes to the events list since the previous broadcast"""
+        version, events = self.document.events().getVersioned()
         if not self.channelOut:
             self.logger.debug('DocumentAsync.broadcastEventsToFrontends(...) skipped (test mode)')
             return
-        self.logger.debug('DocumentAsync.broadcastEventsToFrontends(...)')
-        self.channelOut.emit("BROADCAST_EVENTS", self.roomFrontend, events)
+        with self.emitLock:
+            if version <= self.lastBroadcastVersion:
+                self.logger.debug('DocumentAsync.broadcastEventsToFrontends(...) skipped (unchanged)')
+                return
+            delta = _eventsDelta(self.lastBroadcastEvents, events)
+            delta['version'] = version
+            delta['previous'] = self.lastBroadcastVersion
+            self.lastBroadcastVersion = version
+            self.lastBroadcastEvents = events
+            self.logger.debug('DocumentAsync.broadcastEventsToFrontends(...)')
+            self.channelOut.emit("BROADCAST_EVENTS", self.roomFrontend, delta)
 
     def forwardDocumentModifications(self, modifications):
         if not self.channelOut:
@@ -1756,6 +2904,129 @@ class DocumentAsync(threading.Thread):
         self.logger.debug('DocumentAsync.incomingDocumentStatus(%s)' % repr(documentState))
         self.document.serve()._setDocumentState(documentState)
 
+class _DueCallbacks(list):
+    """Handler for CallbackPausableClock.handleEvents that collects the callbacks, to be called later"""
+    def schedule(self, callback, *args, **kwargs):
+        self.append((callback, args, kwargs))
+
+
+class DocumentScheduler(threading.Thread):
+    """Triggers (or enqueues) events at given times of the document clock, from its own thread. The thread is
+    started when the first trigger is scheduled (never in test mode: tests call runDue themselves)."""
+
+    def __init__(self, document):
+        threading.Thread.__init__(self, name='scheduler-%s' % document.documentId)
+        self.daemon = True
+        self.document = document
+        self.logger = self.document.logger.getChild('scheduler')
+        self.condition = threading.Condition(threading.Lock())
+        self.pending = {}  # Schedule id -> description of the scheduled trigger
+        self.nextScheduleId = 1
+        self.running = True
+        self.threadStarted = False
+
+    def getLoggerExtra(self):
+        return self.document.getLoggerExtra()
+
+    def add(self, id, parameters=None, verb='trigger', at=None, delay=None):
+        """Schedule trigger (or enqueue) of event id with the given parameters at document clock time at, or after
+        delay seconds of document clock time. Returns the description of the scheduled trigger."""
+        if parameters is None:
+            parameters = []
+        if not verb in ('trigger', 'enqueue'):
+            abort(400, 'Cannot schedule %s' % verb)
+        if self.document.idMap.get(id) is None:
+            self.document.setError('No such xml:id: %s' % id)
+            abort(404, 'No such xml:id: %s' % id)
+        if (at is None) == (delay is None):
+            abort(400, 'Schedule needs either time or delay')
+        if at is not None:
+            at = self._number(at, 'time')
+        else:
+            delay = self._number(delay, 'delay')
+        clock = self.document.clock
+        with self.condition:
+            if at is None:
+                at = clock.now() + delay
+            scheduleId = self.nextScheduleId
+            self.nextScheduleId += 1
+            rv = dict(scheduleId=scheduleId, verb=verb, id=id, parameters=parameters, time=at)
+            self.pending[scheduleId] = rv
+            clock.scheduleAt(rv['time'], self._fire, scheduleId)
+            if not self.threadStarted and self.running and not self.document.testMode:
+                self.threadStarted = True
+                self.start()
+            self.condition.notify()
+        self.logger.info('scheduled %s(%s) at %f' % (verb, id, rv['time']), extra=self.getLoggerExtra())
+        return rv
+
+    def _number(self, value, name):
+        """Return value as a float, or abort with 400 if it is not a (finite) number"""
+        if not isinstance(value, bool):
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                pass
+        if not isinstance(value, float) or math.isnan(value) or math.isinf(value):
+            self.document.setError('Schedule %s must be a number' % name)
+            abort(400, 'Schedule %s must be a number' % name)
+        return value
+
+    def list(self):
+        """Return the descriptions of the pending scheduled triggers, earliest first"""
+        with self.condition:
+            return sorted(self.pending.values(), key=lambda entry: (entry['time'], entry['scheduleId']))
+
+    def cancel(self, scheduleId):
+        """Cancel a scheduled trigger. Returns False if it does not exist (or has already fired)."""
+        with self.condition:
+            return self.pending.pop(scheduleId, None) is not None
+
+    def wakeup(self):
+        """Make the scheduler thread look at the clock again"""
+        with self.condition:
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def run(self):
+        clock = self.document.clock
+        while True:
+            with self.condition:
+                if not self.running:
+                    return
+                delay = clock.nextEventTime(default=None)
+                if delay is None or (delay > 0 and not clock.running):
+                    # Nothing scheduled, or the clock is paused: wait until that changes
+                    self.condition.wait()
+                    continue
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+            self.runDue()
+
+    def runDue(self):
+        """Trigger the scheduled events whose time has come. Called by the scheduler thread."""
+        due = _DueCallbacks()
+        self.document.clock.handleEvents(due)
+        for callback, args, kwargs in due:
+            callback(*args, **kwargs)
+
+    def _fire(self, scheduleId):
+        with self.condition:
+            entry = self.pending.pop(scheduleId, None)
+        if entry is None:
+            return  # Cancelled
+        self.logger.info('firing scheduled %s(%s)' % (entry['verb'], entry['id']), extra=self.getLoggerExtra())
+        try:
+            getattr(self.document.events(), entry['verb'])(entry['id'], entry['parameters'])
+        except Exception as e:
+            self.logger.error('scheduled %s(%s) failed: %s' % (entry['verb'], entry['id'], e), extra=self.getLoggerExtra())
+
+
 class DocumentEditing:
     def __init__(self, document):
         self.document = document
@@ -1765,15 +3036,17 @@ class DocumentEditing:
         self.logger.debug('DocumentEditing: created')
         threading.Thread.__init__(self)
 
+    @shared
     def getChapters(self):
         """Return complete chapter tree.
         Returns: {id=str, name=str, tracks=[{id=str, region=str}], chapters=[...]}
         """
-        exprChapter = ".//tl:par[@au:type='chapter']"
-        rootChapterElt = self.tree.getroot().find(exprChapter, NAMESPACES)
+        chapterElements = [elt for elt in self.document._getElementsByType('chapter') if elt.tag == NS_TIMELINE('par')]
+        rootChapterElt = chapterElements[0] if chapterElements else None
         rv = self._getChapterInfo(rootChapterElt, includeChapters=True, includeElements=True)
         return rv
 
+    @shared
     def getChapter(self, chapterId):
         """Return per-chapter datastructure.
         Returns: {id=str, name=str, tracks=[{id=str, region=str, elements=[{asset=str, begin=float, dur=float}]}]}
@@ -1889,7 +3162,7 @@ class DocumentEditing:
         if chapterElt == None: abort(404, "No element with xml:id=%s" % chapterID)
         parentElt = self.document._getParent(chapterElt)
         if parentElt == None: abort(500, "No parent element for %s" % chapterID)
-        pos = list(parentElt).index(chapterElt)
+        pos = self.document._getChildPosition(chapterElt)
         newElt = self._createChapter()
         parentElt.insert(pos, newElt)
         self.document._elementAdded(newElt, parentElt)
@@ -1904,9 +3177,9 @@ class DocumentEditing:
         if chapterElt == None: abort(404, "No element with xml:id=%s" % chapterID)
         parentElt = self.document._getParent(chapterElt)
         if parentElt == None: abort(500, "No parent element for %s" % chapterID)
-        pos = list(parentElt).index(chapterElt)
+        pos = self.document._getChildPosition(chapterElt)
         newElt = self._createChapter()
-        if pos+1 >= len(list(parentElt)):
+        if pos+1 >= len(parentElt):
             parentElt.append(newElt)
         else:
             parentElt.insert(pos+1, newElt)
@@ -1952,7 +3225,7 @@ class DocumentEditing:
         chapterElt = self.document._getElementByID(chapterID)
         if chapterElt == None: abort(404, "No element with xml:id=%s" % chapterID)
         chapterElt.set(NS_AUTH("name"), name)
-        self.document._elementChanged(chapterElt)
+        self.document._elementChanged(chapterElt, {NS_AUTH("name"): name})
 
     @edit
     def deleteChapter(self, chapterID):
@@ -1961,8 +3234,7 @@ class DocumentEditing:
         if chapterElt == None: abort(404, "No element with xml:id=%s" % chapterID)
         parentElt = self.document._getParent(chapterElt)
         if parentElt == None: abort(500, "No parent element for %s" % chapterID)
-        parentElt.remove(chapterElt)
-        self.document._elementDeleted(chapterElt)
+        self.document._removeElement(chapterElt, parentElt)
 
     @edit
     def addTrack(self, chapterID, regionID):
@@ -1991,8 +3263,7 @@ class DocumentEditing:
         if trackElt == None: return
         parentElt = self.document._getParent(trackElt)
         if parentElt == None: abort(500, "No parent element for %s" % trackID)
-        parentElt.remove(trackElt)
-        self.document._elementDeleted(trackElt)
+        self.document._removeElement(trackElt, parentElt)
 
     @edit
     def addElement(self, trackID, assetID, insertPosition=None):
@@ -2043,7 +3314,7 @@ class DocumentEditing:
         if beginSleepElt == None: abort(404, "No tl:sleep element in %s" % elementID)
         delay = str(delay)
         beginSleepElt.set(NS_TIMELINE("dur"), delay)
-        self.document._elementChanged(beginSleepElt)
+        self.document._elementChanged(beginSleepElt, {NS_TIMELINE("dur"): delay})
 
     @edit
     def setElementDuration(self, elementID, duration):
@@ -2054,7 +3325,7 @@ class DocumentEditing:
         if durSleepElt == None: abort(404, "No tl:par/tl:sleep element in %s" % elementID)
         duration = str(duration)
         durSleepElt.set(NS_TIMELINE("dur"), duration)
-        self.document._elementChanged(durSleepElt)
+        self.document._elementChanged(durSleepElt, {NS_TIMELINE("dur"): duration})
 
     @edit
     def deleteElement(self, elementID):
@@ -2063,6 +3334,5 @@ class DocumentEditing:
         if elt == None: return
         parentElt = self.document._getParent(elt)
         if parentElt == None: abort(500, "No parent element for %s" % elementID)
-        parentElt.remove(elt)
-        self.document._elementDeleted(elt)
+        self.document._removeElement(elt, parentElt)
 
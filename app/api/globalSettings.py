@@ -54,6 +54,46 @@ class GlobalSettings(object):
         None
     )
 
+    # XML tree implementation for documents (elementtree or lxml). Only read at startup.
+    xmlBackend = os.getenv(
+        "XML_BACKEND",
+        "elementtree"
+    )
+
+    # Number of generations of document changes kept for gethistory. Older ones require a resync.
+    historyWindow = int(os.getenv(
+        "HISTORY_WINDOW",
+        "10000"
+    ))
+
+    # Number of generations between the document checkpoints used by catchup
+    checkpointInterval = int(os.getenv(
+        "CHECKPOINT_INTERVAL",
+        "100"
+    ))
+
+    # Number of document checkpoints kept for catchup (each is a complete copy of the document)
+    maxCheckpoints = int(os.getenv(
+        "MAX_CHECKPOINTS",
+        "2"
+    ))
+
+    # Maximum number of edits waiting for a document, and the time (seconds) an edit waits before giving up
+    editQueueDepth = int(os.getenv(
+        "EDIT_QUEUE_DEPTH",
+        "32"
+    ))
+    editTimeout = float(os.getenv(
+        "EDIT_TIMEOUT",
+        "10"
+    ))
+
+    # Minimum time (seconds) between two broadcasts of the events list of a document to the trigger tool
+    broadcastInterval = float(os.getenv(
+        "BROADCAST_INTERVAL",
+        "0.1"
+    ))
+
     # Mode in which the preview player runs (tv or standalone)
     mode = "standalone"
 
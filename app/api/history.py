@@ -0,0 +1,84 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from builtins import object
+#
+# Bounded history of the operations forwarded for each generation of a document.
+#
+# Only generations that have operations are stored. The most recent ones are kept as they are, older ones
+# are kept in zlib-compressed JSON segments, and segments that fall completely outside the retention window
+# are dropped. Clients asking for generations that have been dropped must resynchronize.
+#
+import collections
+import json
+import zlib
+
+SEGMENT_SIZE = 256  # Number of non-empty generations per compressed segment
+
+
+class OperationHistory(object):
+    """The (generation, operations) tuples of the last window generations"""
+
+    def __init__(self, window, segmentSize=SEGMENT_SIZE):
+        self.window = window
+        self.segmentSize = segmentSize
+        self.hot = []       # Recent (generation, operations) tuples
+        self.cold = collections.deque()  # (first generation, last generation, compressed JSON) segments
+        self.generation = -1    # Newest generation
+
+    def __len__(self):
+        """Number of generations covered, like the length of the list of all of them"""
+        return self.generation + 1
+
+    def append(self, gen, operations):
+        assert gen > self.generation
+        self.generation = gen
+        if operations:
+            self.hot.append((gen, operations))
+            if len(self.hot) >= self.segmentSize:
+                self._freeze()
+        self._expire()
+
+    def _freeze(self):
+        """Compress the hot generations into a cold segment"""
+        data = zlib.compress(json.dumps(self.hot).encode('utf-8'))
+        self.cold.append((self.hot[0][0], self.hot[-1][0], data))
+        self.hot = []
+
+    def _expire(self):
+        """Drop the cold segments that are completely outside the window"""
+        oldest = self.oldest()
+        while self.cold and self.cold[0][1] < oldest:
+            self.cold.popleft()
+
+    def oldest(self):
+        """Return the oldest generation that is still available"""
+        return max(0, self.generation + 1 - self.window)
+
+    def get(self, oldest=0):
+        """Return the list of (generation, operations) tuples for the generations from oldest that have
+        operations, ending with the current generation (also if it has none), so the client knows where it
+        is. Returns None if oldest is no longer available."""
+        if oldest < self.oldest():
+            return None
+        rv = []
+        for first, last, data in self.cold:
+            if last >= oldest:
+                rv += [(gen, operations) for gen, operations in json.loads(zlib.decompress(data).decode('utf-8')) if gen >= oldest]
+        rv += [entry for entry in self.hot if entry[0] >= oldest]
+        if self.generation >= oldest and (not rv or rv[-1][0] != self.generation):
+            rv.append((self.generation, []))
+        return rv
@@ -144,9 +144,11 @@ def document_instance(documentId):
 @app.route(API_ROOT + "/document/<uuid:documentId>", methods=["DELETE"])
 def delete_document(documentId):
     try:
-        del api.documents[documentId]
+        document = api.documents.pop(documentId)
     except KeyError:
         abort(404)
+    if document.schedulerHandler:
+        document.schedulerHandler.stop()
 
     return ""
 
@@ -206,6 +208,21 @@ def document_xml_modify(documentId):
     return rv
 
 
+@app.route(API_ROOT + "/document/<uuid:documentId>/xml/batch", methods=["POST"])
+def document_xml_batch(documentId):
+    try:
+        document = api.documents[documentId]
+    except KeyError:
+        abort(404)
+    xml = document.xml()
+    assert xml
+    operations = request.get_json()
+    if not isinstance(operations, list):
+        abort(400, "Expected a JSON list of operations")
+    rv = xml.batch(operations)
+    return Response(json.dumps(rv), mimetype="application/json")
+
+
 #
 # per-document, authoring aspect, for the authoring tool
 #
@@ -222,10 +239,67 @@ def document_events_get(documentId):
         abort(404)
     events = document.events()
     assert events
+    if 'since' in request.args:
+        # Changes since that version, for a client that missed broadcasts (or a snapshot if they are gone)
+        try:
+            since = int(request.args['since'])
+        except ValueError:
+            abort(400, "since must be a version number")
+        rv = events.getSince(since)
+        return Response(json.dumps(rv), mimetype="application/json")
     rv = events.get()
     return Response(json.dumps(rv["events"]), mimetype="application/json")
 
 
+@app.route(API_ROOT + "/document/<uuid:documentId>/events/batch", methods=["POST"])
+def document_events_batch(documentId):
+    try:
+        document = api.documents[documentId]
+    except KeyError:
+        abort(404)
+    events = document.events()
+    assert events
+    actions = request.get_json()
+    if not isinstance(actions, list):
+        abort(400, "Expected a JSON list of actions")
+    rv = events.batch(actions)
+    return Response(json.dumps(rv), mimetype="application/json")
+
+
+@app.route(API_ROOT + "/document/<uuid:documentId>/events/schedule", methods=["GET", "POST"])
+def document_events_schedule(documentId):
+    try:
+        document = api.documents[documentId]
+    except KeyError:
+        abort(404)
+    scheduler = document.scheduler()
+    assert scheduler
+    if request.method == 'POST':
+        args = request.get_json()
+        if not isinstance(args, dict) or not 'id' in args:
+            abort(400, "Expected a JSON object with an id")
+        parameters = args.get('parameters', [])
+        if not isinstance(parameters, list):
+            abort(400, "Expected a list of parameters")
+        rv = scheduler.add(args['id'], parameters, verb=args.get('verb', 'trigger'), at=args.get('time'), delay=args.get('delay'))
+    else:
+        rv = scheduler.list()
+    return Response(json.dumps(rv), mimetype="application/json")
+
+
+@app.route(API_ROOT + "/document/<uuid:documentId>/events/schedule/<int:scheduleId>", methods=["DELETE"])
+def document_events_schedule_cancel(documentId, scheduleId):
+    try:
+        document = api.documents[documentId]
+    except KeyError:
+        abort(404)
+    scheduler = document.scheduler()
+    assert scheduler
+    return jsonify({
+        "status": scheduler.cancel(scheduleId)
+    })
+
+
 @app.route(API_ROOT + "/document/<uuid:documentId>/events/<id>/trigger", methods=["POST"])
 def document_events_trigger(documentId, id):
     try:
@@ -462,6 +536,18 @@ def get_history(documentId):
     history = serve.gethistory(oldest=oldest)
     return Response(json.dumps(history), mimetype="application/json")
 
+@app.route(API_ROOT + "/document/<uuid:documentId>/serve/catchup")
+def get_catchup(documentId):
+    try:
+        document = api.documents[documentId]
+    except KeyError:
+        abort(404)
+    serve = document.serve()
+    assert serve
+    generation = request.args.get('generation', None)
+    rv = serve.catchup(generation=generation)
+    return Response(json.dumps(rv), mimetype="application/json")
+
 #
 # Per-document, serve aspect, for view-only (non-preview-player) consumption of views on the document
 #
@@ -524,6 +610,18 @@ def get_viewer_history(documentId):
     history = serve.gethistory(oldest=oldest, viewer=True)
     return Response(json.dumps(history), mimetype="application/json")
 
+@app.route(API_ROOT + "/document/<uuid:documentId>/viewer/catchup")
+def get_viewer_catchup(documentId):
+    try:
+        document = api.documents[documentId]
+    except KeyError:
+        abort(404)
+    serve = document.serve()
+    assert serve
+    generation = request.args.get('generation', None)
+    rv = serve.catchup(generation=generation, viewer=True)
+    return Response(json.dumps(rv), mimetype="application/json")
+
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/viewer")
 def get_viewer_preview(documentId):
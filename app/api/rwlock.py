@@ -0,0 +1,206 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from builtins import object
+#
+# Readers-writer lock for documents.
+#
+# Used as a drop-in replacement for an RLock: acquire(), release() and "with lock:" take it exclusively,
+# and are reentrant. Read-only operations use "with lock.shared():" so they can run concurrently. A thread
+# that holds the lock (in either mode) can always take it shared again. A thread that only holds the lock
+# shared cannot upgrade to exclusive: that would deadlock with another reader doing the same, so it raises
+# an error. Waiting writers have preference over new readers, so a stream of reads cannot starve edits.
+#
+# Edits also queue up in an EditQueue before taking the lock, so they are done in order of arrival, and
+# requests give up (instead of piling up) when a document has too many edits waiting.
+#
+import contextlib
+import threading
+import time
+
+
+class LockStatistics(object):
+    """Counts acquisitions of a lock in one mode, and the time spent waiting for them"""
+
+    def __init__(self):
+        self.acquired = 0
+        self.contended = 0  # Acquisitions that had to wait
+        self.waitTotal = 0.0
+        self.waitMax = 0.0
+
+    def record(self, waited):
+        self.acquired += 1
+        if waited is not None:
+            self.contended += 1
+            self.waitTotal += waited
+            self.waitMax = max(self.waitMax, waited)
+
+    def get(self):
+        return dict(acquired=self.acquired, contended=self.contended, waitTotal=self.waitTotal, waitMax=self.waitMax)
+
+
+class RWLock(object):
+    """Readers-writer lock, reentrant for the writer"""
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        self.writer = None      # Thread holding the lock exclusively
+        self.writerCount = 0    # Recursion level of the writer
+        self.readers = {}       # Threads holding the lock shared, with their recursion level
+        self.writersWaiting = 0
+        self.exclusiveStatistics = LockStatistics()
+        self.sharedStatistics = LockStatistics()
+
+    def acquire(self):
+        """Take the lock exclusively"""
+        me = threading.current_thread()
+        with self.condition:
+            if self.writer is me:
+                self.writerCount += 1
+                return True
+            if me in self.readers:
+                raise RuntimeError('Cannot upgrade shared lock to exclusive')
+            waited = None
+            if self.writer is not None or self.readers:
+                start = time.time()
+                self.writersWaiting += 1
+                try:
+                    while self.writer is not None or self.readers:
+                        self.condition.wait()
+                finally:
+                    self.writersWaiting -= 1
+                waited = time.time() - start
+            self.writer = me
+            self.writerCount = 1
+            self.exclusiveStatistics.record(waited)
+        return True
+
+    def release(self):
+        with self.condition:
+            if self.writer is not threading.current_thread():
+                raise RuntimeError('Cannot release un-acquired lock')
+            self.writerCount -= 1
+            if self.writerCount == 0:
+                self.writer = None
+                self.condition.notify_all()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+    def heldExclusively(self):
+        """Return True if the current thread holds the lock exclusively"""
+        return self.writer is threading.current_thread()
+
+    def acquireShared(self):
+        me = threading.current_thread()
+        with self.condition:
+            if self.writer is me or me in self.readers:
+                # Nested: never wait, or we would deadlock with a waiting writer
+                self.readers[me] = self.readers.get(me, 0) + 1
+                return True
+            waited = None
+            if self.writer is not None or self.writersWaiting:
+                start = time.time()
+                while self.writer is not None or self.writersWaiting:
+                    self.condition.wait()
+                waited = time.time() - start
+            self.readers[me] = 1
+            self.sharedStatistics.record(waited)
+        return True
+
+    def releaseShared(self):
+        me = threading.current_thread()
+        with self.condition:
+            count = self.readers.get(me)
+            if not count:
+                raise RuntimeError('Cannot release un-acquired shared lock')
+            if count > 1:
+                self.readers[me] = count - 1
+            else:
+                del self.readers[me]
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def shared(self):
+        """Context manager that holds the lock in shared mode"""
+        self.acquireShared()
+        try:
+            yield self
+        finally:
+            self.releaseShared()
+
+    def getStatistics(self):
+        with self.condition:
+            return dict(exclusive=self.exclusiveStatistics.get(), shared=self.sharedStatistics.get())
+
+
+class EditQueueFull(Exception):
+    pass
+
+
+class EditQueueTimeout(Exception):
+    pass
+
+
+class EditQueue(object):
+    """Lets edits of a document go ahead one at a time, in order of arrival. At most maxDepth edits can be
+    waiting or running, and an edit gives up if it has not had its turn after timeout seconds."""
+
+    def __init__(self, maxDepth, timeout):
+        self.maxDepth = maxDepth
+        self.timeout = timeout
+        self.condition = threading.Condition(threading.Lock())
+        self.nextTicket = 0     # Ticket for the next edit to arrive
+        self.serving = 0        # Ticket of the edit whose turn it is
+        self.cancelled = set()  # Tickets of edits that gave up
+        self.statistics = LockStatistics()
+
+    def __len__(self):
+        """Number of edits waiting or running"""
+        with self.condition:
+            return self.nextTicket - self.serving - len(self.cancelled)
+
+    def enter(self):
+        """Wait for our turn. Raises EditQueueFull or EditQueueTimeout."""
+        with self.condition:
+            if self.nextTicket - self.serving - len(self.cancelled) >= self.maxDepth:
+                raise EditQueueFull()
+            ticket = self.nextTicket
+            self.nextTicket += 1
+            waited = None
+            if self.serving != ticket:
+                start = time.time()
+                deadline = start + self.timeout
+                while self.serving != ticket:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.cancelled.add(ticket)
+                        raise EditQueueTimeout()
+                    self.condition.wait(remaining)
+                waited = time.time() - start
+            self.statistics.record(waited)
+
+    def leave(self):
+        """Our edit is done, give the next one its turn"""
+        with self.condition:
+            self.serving += 1
+            while self.serving in self.cancelled:
+                self.cancelled.remove(self.serving)
+                self.serving += 1
+            self.condition.notify_all()
@@ -0,0 +1,202 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+#
+# XML tree implementations for the document model.
+#
+# The standard library ElementTree is always available. lxml is used if it is installed and selected
+# with the XML_BACKEND setting: it gives real XPath (including the parent axis) and C-speed parsing.
+# Both backends serialize with the ElementTree serializer, so they produce exactly the same XML.
+# The backend is chosen once, when the document module is imported.
+#
+from builtins import object
+from builtins import str
+import io
+import re
+import sys
+import xml.etree.ElementTree
+
+import logging
+logger = logging.getLogger(__name__)
+
+if sys.version_info[0] < 3:
+    XML_ENCODING=""
+else:
+    XML_ENCODING="unicode"
+
+# Clark-notation {namespace} prefix of a tag name in a path
+FIND_CLARK_NAMESPACE = re.compile(r'\{([^}]*)\}')
+
+
+class FilteredElement(object):
+    """Read-only view of an ElementTree element for the serializer, with the attributes of every element
+    replaced by getAttributes(element). Used to serialize a filtered tree without copying it."""
+    __slots__ = ('element', 'getAttributes')
+
+    def __init__(self, element, getAttributes):
+        self.element = element
+        self.getAttributes = getAttributes
+
+    @property
+    def tag(self):
+        return self.element.tag
+
+    @property
+    def text(self):
+        return self.element.text
+
+    @property
+    def tail(self):
+        return self.element.tail
+
+    def items(self):
+        return self.getAttributes(self.element)
+
+    def __len__(self):
+        return len(self.element)
+
+    def __iter__(self):
+        for child in self.element:
+            yield FilteredElement(child, self.getAttributes)
+
+    def iter(self, tag=None):
+        assert tag is None
+        yield self
+        for child in self:
+            for e in child.iter():
+                yield e
+
+
+class ElementTreeBackend(object):
+    """Tree implementation using the standard library xml.etree.ElementTree"""
+    name = 'elementtree'
+    hasXPath = False
+
+    def __init__(self):
+        self.ET = xml.etree.ElementTree
+        self.ParseError = self.ET.ParseError
+
+    def isElement(self, obj):
+        return isinstance(obj, self.ET.Element)
+
+    def registerNamespace(self, prefix, uri):
+        self.ET.register_namespace(prefix, uri)
+
+    def iterparse(self, fp):
+        return self.ET.iterparse(fp, events=('start', 'end'))
+
+    def fromstring(self, data):
+        return self.ET.fromstring(data)
+
+    def tostring(self, element):
+        return self.ET.tostring(element, encoding=XML_ENCODING)
+
+    def tostringFiltered(self, element, getAttributes):
+        """Serialize element with the attributes of every element replaced by getAttributes(element)"""
+        return self.ET.tostring(FilteredElement(element, getAttributes), encoding=XML_ENCODING)
+
+    def documentElement(self, root):
+        """Return an element to use as the document node for absolute paths."""
+        # Workaround for XPath nastiness in ET: it does not handle / correctly so we help it a bit.
+        documentElement = self.ET.Element('')
+        documentElement.append(root)
+        return documentElement
+
+    def findAbsolute(self, documentElement, path, namespaces):
+        return documentElement.findall('.'+path, namespaces)
+
+
+class LxmlBackend(object):
+    """Tree implementation using lxml.etree"""
+    name = 'lxml'
+    hasXPath = True
+
+    def __init__(self):
+        import lxml.etree
+        self.ET = lxml.etree
+        self.ParseError = self.ET.ParseError
+        # ElementTree drops comments and processing instructions, so we do the same
+        self.parser = self.ET.XMLParser(remove_comments=True, remove_pis=True)
+
+    def isElement(self, obj):
+        return isinstance(obj, self.ET._Element)
+
+    def registerNamespace(self, prefix, uri):
+        # The ElementTree serializer picks the prefixes, so it needs to know them too
+        self.ET.register_namespace(prefix, uri)
+        xml.etree.ElementTree.register_namespace(prefix, uri)
+
+    def iterparse(self, fp):
+        if isinstance(fp, io.TextIOBase):
+            # lxml only parses bytes
+            fp = io.BytesIO(fp.read().encode('utf-8'))
+        return self.ET.iterparse(fp, events=('start', 'end'), remove_comments=True, remove_pis=True)
+
+    def fromstring(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return self.ET.fromstring(data, self.parser)
+
+    def tostring(self, element):
+        # lxml's own serializer writes <a/> and declares namespaces wherever they are in scope, which
+        # differs from ElementTree. Patching its output up costs more than the ElementTree serializer itself
+        # (see test/benchmark.py), and that serializer only needs the element interface, so use it.
+        return xml.etree.ElementTree.tostring(element, encoding=XML_ENCODING)
+
+    def tostringFiltered(self, element, getAttributes):
+        return xml.etree.ElementTree.tostring(FilteredElement(element, getAttributes), encoding=XML_ENCODING)
+
+    def documentElement(self, root):
+        # Absolute XPaths work from any element, so there is no need for a separate document node
+        # (and an lxml element cannot have two parents anyway)
+        return root
+
+    def findAbsolute(self, documentElement, path, namespaces):
+        path, namespaces = self._prefixed(path, namespaces)
+        return documentElement.xpath(path, namespaces=namespaces)
+
+    def _prefixed(self, path, namespaces):
+        """XPath has no Clark notation, so replace {namespace} by a prefix (and add it to the namespaces)"""
+        if not '{' in path:
+            return path, namespaces
+        namespaces = dict(namespaces)
+        prefixes = {v: k for k, v in namespaces.items()}
+
+        def prefix(match):
+            url = match.group(1)
+            if not url in prefixes:
+                prefixes[url] = 'ns%d' % len(namespaces)
+                namespaces[prefixes[url]] = url
+            return prefixes[url] + ':'
+        return FIND_CLARK_NAMESPACE.sub(prefix, path), namespaces
+
+
+BACKENDS = {
+    ElementTreeBackend.name: ElementTreeBackend,
+    LxmlBackend.name: LxmlBackend,
+}
+
+
+def getBackend(name):
+    """Return the tree implementation called name, falling back to ElementTree if it is not available"""
+    if not name in BACKENDS:
+        logger.warning('Unknown XML backend %s, using %s' % (name, ElementTreeBackend.name))
+        name = ElementTreeBackend.name
+    try:
+        return BACKENDS[name]()
+    except ImportError:
+        logger.warning('XML backend %s not available, using %s' % (name, ElementTreeBackend.name))
+        return ElementTreeBackend()
@@ -58,6 +58,48 @@ export interface Event {
   productionId: string;
 }
 
+/**
+ * Changes to the event list relative to version `previous`, as broadcast in
+ * `EVENTS` messages and returned by `GET /events?since=<version>`
+ */
+interface EventsDelta {
+  version: number;
+  previous: number;
+  added: Array<Event>;
+  changed: Array<Event>;
+  removed: Array<string>;
+  order: Array<string>;
+  remote: PreviewStatus;
+}
+
+/**
+ * Complete event list, returned by `GET /events?since=<version>` if the
+ * changes since that version are no longer available
+ */
+interface EventsSnapshot {
+  resyncRequired: true;
+  version: number;
+  events: Array<Event>;
+  remote: PreviewStatus;
+}
+
+/**
+ * Returns a new event list with the changes in the given delta applied.
+ *
+ * @param events Event list at version `delta.previous`
+ * @param delta Changes to apply
+ * @returns Event list at version `delta.version`
+ */
+function applyEventsDelta(events: Array<Event>, delta: EventsDelta): Array<Event> {
+  const eventsById: { [id: string]: Event } = {};
+
+  events.forEach((event) => eventsById[event.id] = event);
+  delta.removed.forEach((id) => delete eventsById[id]);
+  delta.added.concat(delta.changed).forEach((event) => eventsById[event.id] = event);
+
+  return delta.order.filter((id) => id in eventsById).map((id) => eventsById[id]);
+}
+
 /**
  * Props for TriggerClient
  */
@@ -89,6 +131,8 @@ interface TriggerClientState {
  */
 class TriggerClient extends React.Component<TriggerClientProps, TriggerClientState> {
   private socket: SocketIOClient.Socket;
+  // Version of the event list in the state, 0 before the first fetch
+  private eventsVersion = 0;
 
   constructor(props: TriggerClientProps) {
     super(props);
@@ -106,24 +150,20 @@ class TriggerClient extends React.Component<TriggerClientProps, TriggerClientSta
   }
 
   /**
-   * Fetches a list of events from the API and updates the state accordingly.
-   * If the request fails, the error condition is set which causes the render
-   * method to display an error message.
+   * Fetches the changes to the list of events since the version we have from
+   * the API (or the complete list the first time round) and updates the state
+   * accordingly. If the request fails, the error condition is set which causes
+   * the render method to display an error message.
    */
   private async fetchEvents() {
     // Fetch events via the REST interface
-    const url = `/api/v1/document/${this.props.documentId}/events`;
+    const url = `/api/v1/document/${this.props.documentId}/events?since=${this.eventsVersion}`;
     console.log("updating events");
 
     try {
       // Make request and update state
       const data = await makeRequest("GET", url);
-      const events: Array<Event> = JSON.parse(data);
-
-      this.setState({
-        events,
-        pageIsLoading: false
-      });
+      this.updateEvents(JSON.parse(data));
     } catch (err) {
       // Set error message if request fails
       console.error("Could not fetch triggers:", err);
@@ -134,6 +174,42 @@ class TriggerClient extends React.Component<TriggerClientProps, TriggerClientSta
     }
   }
 
+  /**
+   * Updates the event list in the state with changes or a complete list
+   * received from the backend. Updates we already have are ignored, and if
+   * changes do not apply to the version we have some were missed, so they are
+   * fetched from the API.
+   *
+   * @param data Changes to or complete version of the event list
+   */
+  private updateEvents(data: EventsDelta | EventsSnapshot) {
+    if (data.version <= this.eventsVersion) {
+      return;
+    }
+
+    if ("resyncRequired" in data) {
+      // Complete list, replaces whatever we have
+      this.eventsVersion = data.version;
+      this.setState({
+        events: data.events,
+        previewStatus: data.remote,
+        pageIsLoading: false
+      });
+    } else if (data.previous !== this.eventsVersion) {
+      console.log("Missed event updates, fetching changes since version", this.eventsVersion);
+      this.fetchEvents();
+    } else {
+      const delta: EventsDelta = data;
+
+      this.eventsVersion = delta.version;
+      this.setState((prevState) => ({
+        events: applyEventsDelta(prevState.events, delta),
+        previewStatus: delta.remote,
+        pageIsLoading: false
+      }));
+    }
+  }
+
   /**
    * Subscribes to the `EVENTS` channel of the websocket service to receive
    * event updates. This allows for on-demand updates of the event list without
@@ -170,16 +246,11 @@ class TriggerClient extends React.Component<TriggerClientProps, TriggerClientSta
     });
 
     // Subscribe to the EVENTS event on the channel
-    this.socket.on("EVENTS", (data: { events: Array<Event>, remote: PreviewStatus }) => {
-      console.log("Received trigger event update");
-      const { events, remote } = data;
+    this.socket.on("EVENTS", (data: EventsDelta) => {
+      console.log("Received trigger event update", data.version);
 
-      // Update events and preview status every time a new message comes in
-      this.setState({
-        events,
-        previewStatus: remote,
-        pageIsLoading: false
-      });
+      // Apply the changes to events and preview status every time a new message comes in
+      this.updateEvents(data);
     });
   }
 
@@ -0,0 +1,95 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import print_function
+from __future__ import unicode_literals
+#
+# Compare the XML tree backends on the operations that matter for live triggering.
+#
+# Usage: python benchmark.py [--count N] [backend ...]
+#
+# Every backend is measured in a separate process, because the backend is selected when the document
+# module is imported (from the XML_BACKEND environment variable).
+#
+from future import standard_library
+standard_library.install_aliases()
+import argparse
+import os
+import subprocess
+import sys
+import time
+import urllib.parse
+import urllib.request
+import uuid
+
+DEFAULT_BACKENDS = ['elementtree', 'lxml']
+
+# The app redirects stdout to the logger, so remember the real one
+OUTPUT = sys.stdout
+
+
+def _fixtureUrl():
+    myUrl = urllib.parse.urljoin(u'file:', urllib.request.pathname2url(os.path.abspath(__file__)))
+    return urllib.parse.urljoin(myUrl, u"fixtures/test_events.xml")
+
+
+def _timed(label, count, func):
+    start = time.time()
+    for _ in range(count):
+        func()
+    elapsed = time.time() - start
+    print('%-12s %-12s %8d x %10.3f ms' % (os.getenv('XML_BACKEND'), label, count, 1000.0 * elapsed / count), file=OUTPUT)
+
+
+def run(count):
+    """Run the benchmarks with the backend selected in this process"""
+    import pretest
+    from app.api import document
+    docUrl = _fixtureUrl()
+
+    def load():
+        d = document.Document(uuid.uuid4())
+        d.setTestMode(True)
+        d.load(docUrl)
+        return d
+    _timed('load', count, load)
+
+    d = load()
+    e = d.events()
+    _timed('trigger', count, lambda: e.trigger('event1', []))
+    _timed('events', count, e.get)
+    _timed('get_timeline', count, d.serve().get_timeline)
+    _timed('tostring', count, lambda: document.TREE.tostring(d.tree.getroot()))
+    bigDocument = d.serve().get_timeline()
+    _timed('load big', max(1, count // 10), lambda: document.Document(uuid.uuid4()).loadXml(bigDocument))
+    # Edits forwarded to the timeline service, which gets the XML of added elements
+    d.forwardHandler = d.serve()
+    _timed('trigger fwd', count, lambda: e.trigger('event1', []))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare XML tree backends')
+    parser.add_argument('--count', type=int, default=200, help='Number of repetitions per operation')
+    parser.add_argument('--run', action='store_true', help='Run in this process (internal)')
+    parser.add_argument('backends', nargs='*', default=DEFAULT_BACKENDS, help='Backends to compare')
+    args = parser.parse_args()
+    if args.run:
+        run(args.count)
+        return
+    for backend in args.backends:
+        env = dict(os.environ, XML_BACKEND=backend)
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), '--run', '--count', str(args.count)], env=env)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import unittest
+import threading
+import time
+import uuid
+import requests
+
+from . import pretest
+from app.api import delivery
+from app.api import document
+
+
+class Receiver(object):
+    """Fake callback server: records what was PUT, fails for URLs in self.failing"""
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.received = []
+        self.failing = set()
+        self.lock = threading.Lock()
+
+    def send(self, url, args, timeout):
+        time.sleep(self.delay)
+        if url in self.failing:
+            raise requests.exceptions.ConnectionError('failing')
+        with self.lock:
+            self.received.append((url, args))
+
+    def receivedBy(self, url):
+        return [args for u, args in self.received if u == url]
+
+
+class TestDelivery(unittest.TestCase):
+    def test_order(self):
+        receiver = Receiver(delay=0.001)
+        workers = delivery.Workers(3)
+        pool = delivery.DeliveryPool(send=receiver.send, workers=workers)
+        urls = ['http://cb%d' % i for i in range(5)]
+        for url in urls:
+            pool.add(url)
+        for i in range(20):
+            for url in urls:
+                pool.put(url, i)
+        self.assertTrue(pool.wait(10))
+        for url in urls:
+            self.assertEqual(receiver.receivedBy(url), list(range(20)))
+        self.assertLessEqual(len(workers.threads), 3)
+
+    def test_evict(self):
+        receiver = Receiver()
+        evicted = []
+        pool = delivery.DeliveryPool(onEvict=lambda url, reason: evicted.append(url), send=receiver.send, retries=2, backoff=0.001)
+        pool.add('http://good')
+        pool.add('http://bad')
+        receiver.failing.add('http://bad')
+        pool.put('http://bad', 1)
+        pool.put('http://good', 1)
+        self.assertTrue(pool.wait(10))
+        self.assertEqual(evicted, ['http://bad'])
+        self.assertEqual(pool.urls(), ['http://good'])
+        self.assertEqual(receiver.receivedBy('http://good'), [1])
+
+    def test_retryDoesNotBlock(self):
+        receiver = Receiver()
+        evicted = []
+        workers = delivery.Workers(1)
+        pool = delivery.DeliveryPool(onEvict=lambda url, reason: evicted.append(url), send=receiver.send, workers=workers, retries=2, backoff=0.5)
+        pool.add('http://dead')
+        pool.add('http://healthy')
+        receiver.failing.add('http://dead')
+        pool.put('http://dead', 1)
+        self.assertTrue(self._waitFor(lambda: pool.queues['http://dead'].failures == 1))
+        # The only worker is not waiting for the retry of the dead callback
+        start = time.time()
+        pool.put('http://healthy', 1)
+        self.assertTrue(self._waitFor(lambda: receiver.receivedBy('http://healthy')))
+        self.assertLess(time.time() - start, 0.25)
+        self.assertEqual(evicted, [])
+        self.assertTrue(pool.wait(10))
+        self.assertEqual(evicted, ['http://dead'])
+
+    def _waitFor(self, condition, timeout=10):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def test_unexpectedError(self):
+        receiver = Receiver()
+        evicted = []
+        workers = delivery.Workers(1)
+        pool = delivery.DeliveryPool(onEvict=lambda url, reason: evicted.append(url), send=receiver.send, workers=workers)
+        otherPool = delivery.DeliveryPool(send=receiver.send, workers=workers)
+
+        def send(url, args, timeout):
+            raise ValueError('unexpected')
+        pool.send = send
+        pool.add('http://broken')
+        otherPool.add('http://other')
+        pool.put('http://broken', 1)
+        self.assertTrue(pool.wait(10))
+        self.assertEqual(evicted, ['http://broken'])
+        # The worker survived, and delivers for the other pool
+        otherPool.put('http://other', 1)
+        self.assertTrue(otherPool.wait(10))
+        self.assertEqual(receiver.receivedBy('http://other'), [1])
+        self.assertEqual(len(workers.threads), 1)
+
+    def test_overflow(self):
+        receiver = Receiver()
+        evicted = []
+        pool = delivery.DeliveryPool(onEvict=lambda url, reason: evicted.append(url), send=receiver.send, maxQueue=3)
+        blocked = threading.Event()
+        pool.send = lambda url, args, timeout: blocked.wait()
+        pool.add('http://slow')
+        for i in range(5):
+            pool.put('http://slow', i)
+        self.assertEqual(evicted, ['http://slow'])
+        self.assertNotIn('http://slow', pool)
+        blocked.set()
+        self.assertTrue(pool.wait(10))
+
+    def test_documentServe(self):
+        d = document.Document(uuid.uuid4())
+        d.setTestMode(True)
+        d.loadXml('<root><a/></root>')
+        serve = d.serve()
+        d.forwardHandler = serve
+        receiver = Receiver()
+        serve.callbacks.send = receiver.send
+        serve.callbacks.add('http://first')
+        serve.callbacks.add('http://second')
+
+        serve.forward([])
+        d.xml().modifyAttributes('a', dict(x='1'))
+        self.assertTrue(serve.callbacks.wait(10))
+        first = receiver.receivedBy('http://first')
+        second = receiver.receivedBy('http://second')
+        self.assertEqual(len(first), 2)
+        self.assertTrue(all(args['wantStateUpdates'] for args in first))
+        self.assertEqual(len(second), 1)
+        self.assertNotIn('wantStateUpdates', second[0])
+        self.assertEqual(second[0]['operations'][0]['verb'], 'update')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,9 +22,15 @@ import urllib.request, urllib.parse, urllib.error
 import os
 import json
 import uuid
+import threading
+import time
+from werkzeug.exceptions import HTTPException
 
 from . import pretest
 from app.api import document
+from app.api import xmltree
+from app.api import history
+from app.api import rwlock
 
 DOCUMENT = """
 <testDocument>
@@ -65,6 +71,37 @@ class TestDocument(unittest.TestCase):
 
         self.assertEqual(d._count(), DOCUMENT_COUNT)
 
+    def test_createDocumentStream(self):
+        d = document.Document(uuid.uuid4())
+        docUrl = self._buildUrl('_namespaces')
+        d.loadStream(urllib.request.urlopen(docUrl))
+
+        d2 = document.Document(uuid.uuid4())
+        d2.load(docUrl)
+
+        self.assertEqual(d._count(), d2._count())
+        self.assertEqual(sorted(d.idMap.keys()), sorted(d2.idMap.keys()))
+        self.assertEqual(d.nameSet, d2.nameSet)
+        eventPlayback = d._getElementByID('eventPlayback')
+        self.assertEqual(eventPlayback.get(document.NS_TRIGGER('wantstatus')), 'true')
+        for e in d.tree.getroot().iter():
+            for ch in e:
+                self.assertIs(d._getParent(ch), e)
+
+    def test_createDocumentParseError(self):
+        d = document.Document(uuid.uuid4())
+        d.loadXml(DOCUMENT.strip())
+        oldTree = d.tree
+        oldIds = sorted(d.idMap.keys())
+        with self.assertRaises(HTTPException):
+            d.loadXml('<testDocument><first></testDocument>')
+        self.assertIs(d.tree, oldTree)
+        self.assertEqual(sorted(d.idMap.keys()), oldIds)
+        self.assertEqual(d._count(), DOCUMENT_COUNT)
+        for e in d.tree.getroot().iter():
+            for ch in e:
+                self.assertIs(d._getParent(ch), e)
+
     def test_saveDocument(self):
         d = document.Document(uuid.uuid4())
         docUrl = self._buildUrl()
@@ -78,6 +115,174 @@ class TestDocument(unittest.TestCase):
 
         self.assertEqual(newData, oldData)
 
+    def test_saveInternalAttributes(self):
+        d = document.Document(uuid.uuid4())
+        d.loadXml(DOCUMENT.strip())
+        first = d._getElementByPath('first')
+        first.set(document.NS_TIMELINE_INTERNAL('state'), 'started')
+        first.set(document.NS_TRIGGER('_realDur'), '42')
+        d._getElementByPath('first/firstChild2').set(document.NS_TIMELINE('dur'), '1')
+
+        saved = d._serializeForSave()
+        self.assertIn('xml:id="ttadded" tl:dur="42">', saved)
+        self.assertNotIn('_realDur', saved)
+        self.assertIn('<firstChild2 attr="value" tl:dur="1"', saved)
+        self.assertNotIn('tls:', saved)
+        # The live tree is not modified
+        self.assertEqual(first.get(document.NS_TIMELINE_INTERNAL('state')), 'started')
+        self.assertIsNone(first.get(document.NS_TIMELINE('dur')))
+
+    def test_timelineCache(self):
+        d = document.Document(uuid.uuid4())
+        d.loadXml(DOCUMENT.strip())
+        serve = d.serve()
+        timeline = serve.get_timeline()
+        self.assertIs(serve.get_timeline(), timeline)
+        self.assertEqual(serve.get_timeline(viewer=True), timeline)
+
+        d.xml().modifyAttributes('first/firstChild1', '{"attr": "new"}', 'application/json')
+        newTimeline = serve.get_timeline()
+        self.assertNotEqual(newTimeline, timeline)
+        self.assertIn('<firstChild1 attr="new" />', newTimeline)
+        self.assertEqual(serve.get_timeline(viewer=True), newTimeline)
+
+    def test_timelineCacheConcurrent(self):
+        d = document.Document(uuid.uuid4())
+        d.loadXml(DOCUMENT.strip())
+        serve = d.serve()
+        serializations = []
+
+        def tostring(element):
+            serializations.append(element)
+            time.sleep(0.1)
+            return 'serialized'
+        document.TREE.tostring = tostring
+        try:
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(serve.get_timeline())) for i in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(5)
+        finally:
+            del document.TREE.tostring
+        self.assertEqual(results, ['serialized'] * 5)
+        self.assertEqual(len(serializations), 1)
+
+    def test_history(self):
+        h = history.OperationHistory(window=10, segmentSize=2)
+        h.append(3, [dict(verb='delete', path='/a')])
+        for gen in range(4, 12):
+            h.append(gen, [dict(verb='delete', path='/a[%d]' % gen)] if gen % 3 == 0 else [])
+        self.assertEqual(len(h.cold), 1)
+        self.assertEqual(h.get(0), None)
+        # Only generations with operations, and the current one
+        self.assertEqual([gen for gen, _ in h.get(2)], [3, 6, 9, 11])
+        self.assertEqual(h.get(9), [(9, [dict(verb='delete', path='/a[9]')]), (11, [])])
+        self.assertEqual(h.get(12), [])
+        for gen in range(12, 20):
+            h.append(gen, [dict(verb='delete', path='/a[%d]' % gen)])
+        self.assertEqual(h.oldest(), 10)
+        self.assertTrue(all(last >= 10 for first, last, data in h.cold))
+        self.assertEqual(h.get(10)[-1], (19, [dict(verb='delete', path='/a[19]')]))
+        self.assertEqual([gen for gen, _ in h.get(10)], list(range(12, 20)))
+
+    def test_catchup(self):
+        d = document.Document(uuid.uuid4())
+        d.setTestMode(True)
+        d.loadXml(DOCUMENT.strip())
+        serve = d.serve()
+        d.forwardHandler = serve
+        self.assertEqual(serve.catchup()['operations'], [])
+
+        x = d.xml()
+        oldInterval = document.GlobalSettings.checkpointInterval
+        document.GlobalSettings.checkpointInterval = 10
+        try:
+            for i in range(25):
+                x.modifyAttributes('first/firstChild1', dict(attr=str(i)))
+        finally:
+            document.GlobalSettings.checkpointInterval = oldInterval
+        rv = serve.catchup()
+        self.assertEqual(rv['generation'], 20)
+        self.assertEqual([gen for gen, _ in rv['operations']], list(range(21, 26)))
+        self.assertEqual(serve.catchup(generation=15)['generation'], 10)
+        # Only the newest checkpoints are kept
+        self.assertEqual(len(serve.checkpoints), document.GlobalSettings.maxCheckpoints)
+        self.assertTrue(serve.catchup(generation=0)['resyncRequired'])
+
+        # Replaying the operations on the checkpoint gives the current document
+        dCopy = document.Document(uuid.uuid4())
+        dCopy.loadXml(rv['document'])
+        for gen, operations in rv['operations']:
+            dCopy.forward(operations)
+        self.assertEqual(dCopy._getElementByPath('first/firstChild1').get('attr'), '24')
+
+    def test_rwlock(self):
+        lock = rwlock.RWLock()
+        entered = []
+
+        def reader():
+            with lock.shared():
+                entered.append(True)
+        with lock.shared():
+            # Other readers are not blocked
+            t = threading.Thread(target=reader)
+            t.start()
+            t.join(5)
+            self.assertEqual(entered, [True])
+            # But a reader cannot become a writer
+            self.assertRaises(RuntimeError, lock.acquire)
+        # The writer is reentrant, and can also take the lock shared
+        with lock:
+            with lock:
+                with lock.shared():
+                    pass
+            self.assertIs(lock.writer, threading.current_thread())
+        self.assertIsNone(lock.writer)
+        statistics = lock.getStatistics()
+        self.assertEqual(statistics['shared']['acquired'], 2)
+        self.assertEqual(statistics['exclusive']['acquired'], 1)
+
+    def test_editQueue(self):
+        queue = rwlock.EditQueue(maxDepth=3, timeout=0.05)
+        queue.enter()
+        order = []
+
+        def editor(i):
+            queue.enter()
+            order.append(i)
+            queue.leave()
+        threads = []
+        for i in range(2):
+            threads.append(threading.Thread(target=editor, args=(i,)))
+            threads[-1].start()
+            while len(queue) < i + 2:
+                time.sleep(0.001)
+        self.assertRaises(rwlock.EditQueueFull, queue.enter)
+        queue.leave()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(order, [0, 1])
+        # An edit that does not get its turn in time gives up, and its turn is skipped
+        queue.enter()
+        self.assertRaises(rwlock.EditQueueTimeout, queue.enter)
+        queue.leave()
+        self.assertEqual(len(queue), 0)
+        queue.enter()
+        queue.leave()
+
+    def test_sharedReads(self):
+        d = document.Document(uuid.uuid4())
+        d.loadXml(DOCUMENT.strip())
+        results = []
+        with d.lock.shared():
+            # A reader on another thread can get in while we hold the lock shared
+            t = threading.Thread(target=lambda: results.append(d.xml().get('second/second2', 'application/xml')))
+            t.start()
+            t.join(5)
+        self.assertEqual([r.strip() for r in results], ['<second2 />'])
+
     def test_xpath(self):
         d = document.Document(uuid.uuid4())
         docUrl = self._buildUrl()
@@ -100,6 +305,59 @@ class TestDocument(unittest.TestCase):
 
             self.assertIs(e, e2)
 
+    def test_xpath_prefixed(self):
+        d = document.Document(uuid.uuid4())
+        docUrl = self._buildUrl('_namespaces')
+        d.load(docUrl)
+        root = d.tree.getroot()
+
+        self.assertIs(d._getElementByPath('/tl:document'), root)
+        self.assertIs(d._getElementByPath('/tl:document[1]/tl:par[1]'), root[0])
+        self.assertIs(
+            d._getElementByPath('/tl:document[1]/tl:par[1]/tl:par[2]'),
+            d._getElementByID('event4')
+        )
+        self.assertIs(
+            d._getElementByPath('tl:par/tl:par/tt:events/tl:par[3]'),
+            d._getElementByID('event3')
+        )
+        self.assertIs(
+            d._getElementByPath('.//tl:par[@xml:id="event2"]'),
+            d._getElementByID('event2')
+        )
+
+    def test_xpath_after_edits(self):
+        d = document.Document(uuid.uuid4())
+        d.loadXml(DOCUMENT.strip())
+        x = d.xml()
+
+        # Make sure the positional index is populated before editing
+        for e in d.tree.getroot().iter():
+            d._getXPath(e)
+
+        x.paste('second/second2', 'before', 'second1', '{}', 'application/json')
+        x.paste('second', 'begin', 'second3', '{}', 'application/json')
+        x.cut('second/second1[2]')
+        x.paste('second', 'end', 'second1', '{}', 'application/json')
+        x.paste('first/firstChild1', 'after', 'firstChild2', '{}', 'application/json')
+
+        self.assertEqual(
+            x.get('second', 'application/xml').strip(),
+            '<second><second3 /><second1 /><second2 /><second3 /><second1 /></second>'
+        )
+        for e in d.tree.getroot().iter():
+            p = d._getXPath(e)
+            e2 = d._getElementByPath(p)
+
+            self.assertIs(e, e2)
+            parent = d._getParent(e)
+            if parent is not None:
+                self.assertEqual(d._getChildPosition(e), list(parent).index(e))
+
+    def test_xmlBackendFallback(self):
+        self.assertEqual(xmltree.getBackend('nosuchbackend').name, 'elementtree')
+        self.assertIn(document.TREE.name, xmltree.BACKENDS)
+
 
 if __name__ == '__main__':
     unittest.main()
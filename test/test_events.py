@@ -21,10 +21,23 @@ import urllib.request, urllib.parse, urllib.error
 import urllib.parse
 import os
 import json
+import time
 import uuid
+from werkzeug.exceptions import HTTPException
 
 from . import pretest
+from app.api import clocks
 from app.api import document
+from app.api.globalSettings import GlobalSettings
+
+
+class FakeChannel(object):
+    """Records what is emitted on a websocket channel"""
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, verb, room, data):
+        self.emitted.append((verb, room, data))
 
 
 class TestEvents(unittest.TestCase):
@@ -58,6 +71,168 @@ class TestEvents(unittest.TestCase):
         self.assertEqual(len(allEvents), 4)
         self.assertEqual(d._count(), oldCount)
 
+    def test_getCached(self):
+        d = self._createDocument()
+        e = d.events()
+
+        before = e.get()["events"]
+        self.assertEqual(e.get()["events"], before)
+        self.assertIn(d.idMap['event2'], e.descriptionCache)
+
+        d.xml().modifyAttributes('//tl:par[@xml:id="event2"]/tt:parameters/tt:parameter', {document.NS_TRIGGER('name'): 'length'})
+        self.assertNotIn(d.idMap['event2'], e.descriptionCache)
+        after = e.get()["events"]
+        self.assertEqual([ev['parameters'] for ev in after if ev['id'] == 'event2'][0][0]['name'], 'length')
+        self.assertEqual([ev for ev in after if ev['id'] != 'event2'], [ev for ev in before if ev['id'] != 'event2'])
+
+    def test_broadcastCoalesced(self):
+        d = self._createDocument()
+        a = d.asynch()
+        a.channelOut = FakeChannel()
+        a.roomFrontend = 'room'
+        oldInterval = GlobalSettings.broadcastInterval
+        GlobalSettings.broadcastInterval = 0.2
+        try:
+            a.requestBroadcastToFrontends()
+            self.assertEqual(len(a.channelOut.emitted), 1)
+            first = a.channelOut.emitted[0][2]
+            self.assertEqual(first['previous'], 0)
+            self.assertEqual(len(first['added']), 4)
+            newId = d.events().trigger('event1', [])
+            d.events().trigger('event1', [])
+            self.assertEqual(len(a.channelOut.emitted), 1)
+            time.sleep(0.4)
+            self.assertEqual(len(a.channelOut.emitted), 2)
+            delta = a.channelOut.emitted[1][2]
+            self.assertEqual(delta['previous'], first['version'])
+            self.assertEqual(len(delta['added']), 2)
+            self.assertEqual(delta['changed'], [])
+            self.assertEqual(delta['removed'], [])
+            self.assertEqual(len(delta['order']), 6)
+            self.assertEqual(d.events().getVersioned()[0], delta['version'])
+            # Nothing changed: nothing is broadcast
+            a.requestBroadcastToFrontends()
+            time.sleep(0.4)
+            self.assertEqual(len(a.channelOut.emitted), 2)
+        finally:
+            GlobalSettings.broadcastInterval = oldInterval
+
+    def test_getSince(self):
+        d = self._createDocument()
+        e = d.events()
+        first = e.getSince(0)
+        self.assertTrue(first['resyncRequired'])
+        self.assertEqual(len(first['events']), 4)
+        unchanged = e.getSince(first['version'])
+        self.assertEqual(unchanged['version'], first['version'])
+        self.assertEqual((unchanged['added'], unchanged['changed'], unchanged['removed']), ([], [], []))
+
+        newId = e.trigger('event1', [])
+        delta = e.getSince(first['version'])
+        self.assertNotIn('resyncRequired', delta)
+        self.assertEqual(delta['previous'], first['version'])
+        self.assertEqual([event['id'] for event in delta['added']], [newId])
+        self.assertEqual(len(delta['order']), 5)
+
+        # Older versions are forgotten
+        for i in range(document.EVENTS_HISTORY):
+            e.trigger('event1', [])
+            e.getVersioned()
+        self.assertTrue(e.getSince(first['version'])['resyncRequired'])
+
+    def test_minimalAVT(self):
+        d = document.Document(uuid.uuid4())
+        d.setTestMode(True)
+        d.loadXml('<root><var>one</var><a/></root>')
+        e = d.events()
+        a = d._getElementByPath('/root/a')
+        self.assertEqual(e._minimalAVT('plain', 'x', a), 'plain')
+        self.assertEqual(e._minimalAVT('{tt:value()}-{var}-{tt:value()}:{tt:clock(.)}', 'x', a), 'x-one-x:0')
+        self.assertIs(document._compileAVT('{var}'), document._compileAVT('{var}'))
+        d.xml().modifyData('/root/var', 'two')
+        self.assertEqual(e._minimalAVT('{var}', 'x', a), 'two')
+
+    def test_schedule(self):
+        d = self._createDocument()
+        oldCount = d._count()
+        fastClock = clocks.FastClock()
+        d.clock = clocks.CallbackPausableClock(fastClock)
+        d.clock.start()
+        s = d.scheduler()
+        s.add('event1', [], delay=0.1)
+        cancelled = s.add('event1', delay=0.1)
+        self.assertTrue(s.cancel(cancelled['scheduleId']))
+        self.assertFalse(s.cancel(cancelled['scheduleId']))
+        self.assertEqual(len(s.list()), 1)
+        s.runDue()
+        self.assertEqual(len(s.list()), 1)
+        fastClock.sleep(0.1)
+        s.runDue()
+        self.assertEqual(s.list(), [])
+        self.assertEqual(d._count(), oldCount + 3)
+
+        # Scheduled triggers wait while the document clock is paused
+        d.clock.stop()
+        s.add('event1', [], at=d.clock.now() + 0.05)
+        fastClock.sleep(0.1)
+        s.runDue()
+        self.assertEqual(len(s.list()), 1)
+        d.clock.start()
+        fastClock.sleep(0.1)
+        s.runDue()
+        self.assertEqual(s.list(), [])
+        self.assertEqual(d._count(), oldCount + 6)
+        # In test mode the scheduler thread is never started
+        self.assertFalse(s.is_alive())
+
+    def test_schedulerThread(self):
+        d = self._createDocument()
+        d.setTestMode(False)
+        s = d.scheduler()
+        s.list()
+        s.cancel(1)
+        self.assertFalse(s.is_alive())
+        s.add('event1', [], delay=1000)
+        try:
+            self.assertTrue(s.is_alive())
+        finally:
+            s.stop()
+        s.join(5)
+        self.assertFalse(s.is_alive())
+
+    def test_scheduleBadTime(self):
+        d = self._createDocument()
+        s = d.scheduler()
+        for kwargs in [dict(delay='soon'), dict(at=[1]), dict(delay=float('nan')), dict(at=True)]:
+            with self.assertRaises(HTTPException) as cm:
+                s.add('event1', [], **kwargs)
+            self.assertEqual(cm.exception.code, 400)
+        self.assertEqual(s.list(), [])
+
+    def test_getAfterStateChange(self):
+        d = self._createDocument()
+        e = d.events()
+
+        newId = e.trigger('event1', [])
+        self.assertEqual(len(e.get()["events"]), 5)
+
+        d.serve()._setDocumentState(dict(elementStates={
+            newId: {document.NS_TIMELINE_INTERNAL("state"): "started"},
+            'event4': {document.NS_TIMELINE_INTERNAL("state"): "idle"}
+        }))
+        allEvents = e.get()["events"]
+        self.assertEqual([ev['id'] for ev in allEvents if ev['state'] == 'active'], [newId])
+
+        root = d.tree.getroot()
+        self.assertEqual(
+            d._getActiveElements(),
+            root.findall('.//tl:par/*[@tt:name][@tls:state]', document.NAMESPACES)
+        )
+        self.assertEqual(
+            d._getEventElements(document.NS_TRIGGER('events')),
+            root.findall('.//tt:events/*[@tt:name]', document.NAMESPACES)
+        )
+
     def test_trigger(self):
         d = self._createDocument()
         oldCount = d._count()
@@ -83,6 +258,22 @@ class TestEvents(unittest.TestCase):
 
         self.assertEqual(newData, oldData)
 
+    def test_triggerUniqueIds(self):
+        d = self._createDocument()
+        e = d.events()
+
+        newIds = [e.trigger('event1', []) for i in range(5)]
+        self.assertEqual(newIds, ['event1-%d' % i for i in range(1, 6)])
+        names = [d._getElementByID(id).get(document.NS_TRIGGER('name')) for id in newIds]
+        self.assertEqual(names, ['5 second splash (%d)' % i for i in range(1, 6)])
+
+        e.dequeue(newIds[-1])
+        self.assertNotIn('5 second splash (5)', d.nameSet)
+        # Suffixes are never handed out twice, even after their name or id has been released
+        newId = e.trigger('event1', [])
+        self.assertEqual(newId, 'event1-6')
+        self.assertEqual(d._getElementByID(newId).get(document.NS_TRIGGER('name')), '5 second splash (6)')
+
     def test_modify(self):
         d = self._createDocument()
         oldCount = d._count()
@@ -123,6 +314,70 @@ class TestEvents(unittest.TestCase):
 
         self.assertEqual(newData, oldData)
 
+    def test_triggerTemplate(self):
+        d = self._createDocument()
+        e = d.events()
+        event2 = d.idMap['event2']
+
+        newId = e.trigger('event2', [dict(parameter='./tl:sleep/@tl:dur', value='42')])
+        template = e.templates[event2]
+        newId2 = e.trigger('event2', [dict(parameter='./tl:sleep/@tl:dur', value='43')])
+        self.assertIs(e.templates[event2], template)
+        for id, value in [(newId, '42'), (newId2, '43')]:
+            sleep = d.idMap[id].find('./tl:sleep', document.NAMESPACES)
+            self.assertEqual(sleep.get(document.NS_TIMELINE('dur')), value)
+
+        # Changing the event drops its template
+        d.xml().modifyAttributes('//tl:par[@xml:id="event2"]/tl:sleep', {document.NS_TIMELINE('dur'): '1'})
+        self.assertNotIn(event2, e.templates)
+
+    def test_batch(self):
+        d = self._createDocument()
+        oldCount = d._count()
+        forwarded = []
+
+        class Forwarder(object):
+            def forward(self, commands):
+                forwarded.append(commands)
+        d.forwardHandler = Forwarder()
+        a = d.asynch()
+        a.channelOut = FakeChannel()
+        a.roomFrontend = 'room'
+        e = d.events()
+        d.companionTimelineIsActive = True
+
+        rv = e.batch([
+            dict(verb='trigger', id='event1', parameters=[]),
+            dict(verb='trigger', id='event2', parameters=[dict(parameter='./tl:sleep/@tl:dur', value='42')]),
+            dict(verb='dequeue', id='event4'),
+        ])
+        self.assertEqual(len(rv), 3)
+        self.assertIn(rv[0], d.idMap)
+        self.assertIn(rv[1], d.idMap)
+        self.assertEqual(d._count(), oldCount + 8)
+        self.assertEqual(len(forwarded), 1)
+        self.assertEqual(len(a.channelOut.emitted), 1)
+        self.assertFalse(d.companionTimelineIsActive)
+
+    def test_batchRollback(self):
+        d = self._createDocument()
+        oldData = d._serializeForSave()
+        e = d.events()
+        oldEvents = e.get()['events']
+        d.companionTimelineIsActive = True
+
+        with self.assertRaises(Exception):
+            e.batch([
+                dict(verb='trigger', id='event1', parameters=[]),
+                dict(verb='dequeue', id='event4'),
+                dict(verb='modify', id='event4', parameters=[dict(parameter='tl:sleep/@tl:dur', value='0')]),
+                dict(verb='trigger', id='nonexistent', parameters=[]),
+            ])
+        self.assertEqual(d._serializeForSave(), oldData)
+        self.assertEqual(e.get()['events'], oldEvents)
+        self.assertIsNone(d.editManager)
+        self.assertTrue(d.companionTimelineIsActive)
+
     def test_modifyParameter(self):
         d = self._createDocument()
         oldCount = d._count()
@@ -165,6 +165,120 @@ class TestForward(unittest.TestCase):
 
         self.assertEqual(newData, copyData)
 
+    def test_update(self):
+        d = self._createDocument()
+        dCopy = self._createDocument()
+        forwarded = []
+
+        class Forwarder(object):
+            def forward(self, commands):
+                forwarded.extend(commands)
+                dCopy.forward([dict(command) for command in commands])
+        d.forwardHandler = Forwarder()
+        x = d.xml()
+
+        prio = document.NS_TIMELINE('prio')
+        x.modifyAttributes('tl:par/tl:ref', {'title': None, prio: 'low'})
+        self.assertEqual(len(forwarded), 1)
+        self.assertEqual(forwarded[0]['verb'], 'update')
+        self.assertEqual(json.loads(forwarded[0]['attrs']), {'title': None, prio: 'low'})
+        ref = dCopy._getElementByPath('tl:par/tl:ref')
+        self.assertIsNone(ref.get('title'))
+        self.assertEqual(ref.get(prio), 'low')
+        self.assertEqual(ref.get(document.NS_2IMMERSE('class')), 'video')
+
+    def test_compact(self):
+        d = self._createDocument()
+        dCopy = self._createDocument()
+        forwarded = []
+
+        class Forwarder(object):
+            def forward(self, commands):
+                forwarded.append([command['verb'] for command in commands])
+                dCopy.forward(commands)
+        d.forwardHandler = Forwarder()
+        x = d.xml()
+
+        x.batch([
+            dict(verb='modifyAttributes', path='tl:par', attrs=dict(a='1')),
+            dict(verb='modifyAttributes', path='tl:par', attrs=dict(b='2')),
+            dict(verb='paste', path='tl:par', where='begin', tag='new1', data=dict(a='1')),
+            dict(verb='modifyAttributes', path='tl:par/new1', attrs=dict(b='2')),
+            dict(verb='paste', path='tl:par', where='end', tag='new2', data=dict(a='1')),
+            dict(verb='cut', path='tl:par/new2'),
+        ])
+        self.assertEqual(forwarded, [['update', 'add']])
+        new1 = dCopy._getElementByPath('tl:par/new1')
+        self.assertEqual(dict(new1.attrib), dict(a='1', b='2'))
+        self.assertEqual(dCopy._getElementByPath('tl:par').get('b'), '2')
+        self.assertEqual(dCopy._count(), d._count())
+
+    def test_idAnchor(self):
+        d = self._createDocument()
+        dCopy = self._createDocument()
+        forwarded = []
+
+        class Forwarder(object):
+            def forward(self, commands):
+                forwarded.extend(commands)
+                dCopy.forward(commands)
+        d.forwardHandler = Forwarder()
+        x = d.xml()
+
+        x.modifyAttributes('.//tl:par[@xml:id="event4"]', dict(a='1'))
+        self.assertEqual(forwarded[-1]['id'], 'event4')
+        self.assertEqual(dCopy._getElementByID('event4').get('a'), '1')
+        # The id is used even if the path no longer points at the element
+        forwarded[-1]['path'] = '/nosuchelement'
+        forwarded[-1]['attrs'] = json.dumps(dict(a='2'))
+        dCopy.forward([forwarded[-1]])
+        self.assertEqual(dCopy._getElementByID('event4').get('a'), '2')
+        # Changing the id itself is forwarded by path only
+        x.modifyAttributes('.//tl:par[@xml:id="event4"]', {document.NS_XML('id'): 'event4b'})
+        self.assertNotIn('id', forwarded[-1])
+        self.assertIsNotNone(dCopy._getElementByID('event4b'))
+
+    def test_forwardElement(self):
+        d = self._createDocument()
+        dCopy = self._createDocument()
+        forwarded = []
+        copyForward = dCopy.forward
+
+        def forward(commands):
+            forwarded.extend(commands)
+            copyForward(commands)
+        dCopy.forward = forward
+        d.forwardHandler = dCopy
+        x = d.xml()
+
+        x.batch([dict(verb='paste', path='tl:par', where='begin', tag='new1', data=dict(a='1'))])
+        self.assertEqual(len(forwarded), 1)
+        self.assertNotIn('data', forwarded[0])
+        element = forwarded[0]['element']
+        # The forwarded element is a copy, which is copied again by the receiver
+        self.assertIsNot(element, d._getElementByPath('tl:par/new1'))
+        self.assertIsNot(element, dCopy._getElementByPath('tl:par/new1'))
+        self.assertEqual(dCopy._getElementByPath('tl:par/new1').get('a'), '1')
+
+    def test_forwardData(self):
+        d = self._createDocument()
+        forwarded = []
+
+        class Forwarder(object):
+            def forward(self, commands):
+                forwarded.extend(commands)
+        d.forwardHandler = Forwarder()
+        x = d.xml()
+
+        # Anything but an in-process Document gets the XML only, the element is not copied
+        x.batch([
+            dict(verb='paste', path='tl:par', where='begin', tag='new1', data=dict(a='1')),
+            dict(verb='modifyAttributes', path='tl:par/new1', attrs=dict(b='2')),
+        ])
+        self.assertEqual(len(forwarded), 1)
+        self.assertNotIn('element', forwarded[0])
+        self.assertEqual(forwarded[0]['data'], document.TREE.tostring(d._getElementByPath('tl:par/new1')))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -22,6 +22,7 @@ import urllib.request, urllib.parse, urllib.error
 import os
 import json
 import uuid
+from werkzeug.exceptions import HTTPException
 
 from . import pretest
 from app.api import document
@@ -181,6 +182,120 @@ class TestXML(unittest.TestCase):
         )
         self.assertEqual(d._count(), DOCUMENT_COUNT + 2)
 
+    def test_batch(self):
+        d = document.Document(uuid.uuid4())
+        d.loadXml(DOCUMENT.strip())
+        dCopy = document.Document(uuid.uuid4())
+        dCopy.loadXml(DOCUMENT.strip())
+        forwarded = []
+
+        class Forwarder(object):
+            def forward(self, commands):
+                forwarded.append(list(commands))
+                dCopy.forward(commands)
+        d.forwardHandler = Forwarder()
+        x = d.xml()
+
+        rv = x.batch([
+            dict(verb='move', path='second/second2', where='before', sourcepath='second/second3'),
+            dict(verb='copy', path='third', where='begin', sourcepath='first/firstChild2'),
+            dict(verb='modifyAttributes', path='first', attrs='{"attr": "new"}', mimetype='application/json'),
+            dict(verb='cut', path='first/firstChild1', mimetype='application/xml'),
+        ])
+        self.assertEqual(rv[:3], [
+            '/testDocument/second[1]/second3[1]',
+            '/testDocument/third[1]/firstChild2[1]',
+            '/testDocument/first[1]',
+        ])
+        self.assertEqual(rv[3].strip(), '<firstChild1 />')
+        self.assertEqual(len(forwarded), 1)
+        self.assertEqual(d._count(), DOCUMENT_COUNT)
+        d._zapWhitespace()
+        dCopy._zapWhitespace()
+        self.assertEqual(dCopy.xml().get('/testDocument', 'application/xml'), x.get('/testDocument', 'application/xml'))
+
+    def test_pasteCutForwarded(self):
+        d = document.Document(uuid.uuid4())
+        d.loadXml(DOCUMENT.strip())
+        forwarded = []
+
+        class Forwarder(object):
+            def forward(self, commands):
+                forwarded.append([command['verb'] for command in commands])
+        d.forwardHandler = Forwarder()
+        x = d.xml()
+
+        # Paste and cut are edits by themselves too, not only as part of a batch, copy or move
+        x.paste('third', 'begin', 'fourth', '{"a": "b"}', 'application/json')
+        x.cut('third/fourth')
+        self.assertEqual(forwarded, [['add'], ['delete']])
+        self.assertEqual(d._count(), DOCUMENT_COUNT)
+
+    def test_batchRollback(self):
+        d = document.Document(uuid.uuid4())
+        d.loadXml(DOCUMENT.strip())
+        forwarded = []
+
+        class Forwarder(object):
+            def forward(self, commands):
+                forwarded.append(commands)
+        d.forwardHandler = Forwarder()
+        x = d.xml()
+        oldData = x.get('/testDocument', 'application/xml')
+
+        with self.assertRaises(Exception):
+            x.batch([
+                dict(verb='move', path='second/second1', where='after', sourcepath='first'),
+                dict(verb='paste', path='third', where='replace', tag='fourth', data='{"a": "b"}', mimetype='application/json'),
+                dict(verb='modifyData', path='fourth', data='text'),
+                dict(verb='cut', path='nonexistent'),
+            ])
+        self.assertEqual(x.get('/testDocument', 'application/xml'), oldData)
+        self.assertEqual(d._count(), DOCUMENT_COUNT)
+        self.assertIsNone(d.editManager)
+        self.assertEqual(forwarded, [])
+        for e in d.tree.getroot().iter():
+            self.assertIs(d._getElementByPath(d._getXPath(e)), e)
+
+    def test_changeId(self):
+        d = document.Document(uuid.uuid4())
+        d.loadXml(DOCUMENT.strip())
+        x = d.xml()
+        idAttr = document.NS_XML('id')
+        x.modifyAttributes('first', {idAttr: 'one'}, 'application/x-python-object')
+        first = d._getElementByID('one')
+        self.assertIsNotNone(first)
+        x.modifyAttributes('first', {idAttr: 'two'}, 'application/x-python-object')
+        self.assertIs(d._getElementByID('two'), first)
+        self.assertNotIn('one', d.idMap)
+        with self.assertRaises(Exception):
+            x.batch([
+                dict(verb='modifyAttributes', path='first', attrs={idAttr: 'three'}, mimetype='application/x-python-object'),
+                dict(verb='cut', path='nonexistent'),
+            ])
+        self.assertIs(d._getElementByID('two'), first)
+        self.assertNotIn('three', d.idMap)
+        x.modifyAttributes('first', {idAttr: None}, 'application/x-python-object')
+        self.assertNotIn('two', d.idMap)
+
+    def test_batchBadArguments(self):
+        d = document.Document(uuid.uuid4())
+        d.loadXml(DOCUMENT.strip())
+        x = d.xml()
+        oldData = x.get('/testDocument', 'application/xml')
+        for operation in [
+                dict(verb='cut'),
+                dict(verb='cut', path='first/firstChild1', nonexistent='value'),
+                ]:
+            with self.assertRaises(HTTPException) as cm:
+                x.batch([
+                    dict(verb='move', path='second/second1', where='after', sourcepath='first'),
+                    operation,
+                ])
+            self.assertEqual(cm.exception.code, 400)
+            self.assertEqual(x.get('/testDocument', 'application/xml'), oldData)
+            self.assertIsNone(d.undoLog)
+
 
 if __name__ == '__main__':
     unittest.main()